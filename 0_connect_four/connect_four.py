@@ -1,5 +1,15 @@
+from abc import ABC, abstractmethod
+from array import array
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from enum import Enum
-from typing import List, Tuple, Optional
+from typing import Iterator, List, Sequence, Tuple, Optional
+import mmap
+import os
+import random
+import re
+import struct
+import sys
+import time
 
 
 class GridPosition(Enum):
@@ -8,98 +18,836 @@ class GridPosition(Enum):
   Blue = 2
 
 
+# (row, col) steps for the four line directions: vertical, horizontal and
+# both diagonals
+DIRECTIONS = ((1, 0), (0, 1), (1, 1), (1, -1))
+
+
 class Grid:
+  """Connect-four board kept as one bitboard per color.
+
+  Each column owns ``n_rows + 1`` bits, bottom cell first; the extra bit on
+  top of every column stays empty so that shifts never wrap from one column
+  into the next. ``grid`` still exposes the classic row-major view, with row 0
+  at the top of the board.
+  """
 
   def __init__(self, n_rows: int, n_cols: int) -> None:
     self._n_rows = n_rows
     self._n_cols = n_cols
+    self._stride = n_rows + 1
+    # bit shift for one step vertically, horizontally and along both diagonals
+    self._shifts = (1, self._stride, self._stride + 1, self._stride - 1)
     self.init_grid()
 
   def init_grid(self) -> None:
-    self._grid = [[GridPosition.Empty for _ in range(self._n_cols)]
-                  for _ in range(self._n_rows)]
+    self._boards = [0] * len(GridPosition)  # indexed by GridPosition.value
+    self._heights = [0] * self._n_cols
+    self._run_lengths = [[0] * (self._n_rows * self._n_cols)
+                         for _ in DIRECTIONS]
+    self._last_run_length = 0
 
   @property
   def grid(self) -> List[List[GridPosition]]:
-    return self._grid
+    return [[self._position_at(row_idx, col_idx)
+             for col_idx in range(self._n_cols)]
+            for row_idx in range(self._n_rows)]
+
+  @property
+  def n_rows(self) -> int:
+    return self._n_rows
 
   @property
   def n_cols(self) -> int:
     return self._n_cols
 
+  @property
+  def last_run_length(self) -> int:
+    "length of the longest line through the most recently placed piece"
+    return self._last_run_length
+
+  def bitboard(self, color: GridPosition) -> int:
+    return self._boards[color.value]
+
+  def column_height(self, col: int) -> int:
+    return self._heights[col]
+
   def place_piece(self, col: int, color: GridPosition) -> int:
     if col < 0 or col >= self._n_cols:
       raise ValueError("Invalid column!")
     if color == GridPosition.Empty:
       raise ValueError("Invalid piece color!")
-    for row_idx in range(self._n_rows - 1, -1, -1):
-      if self._grid[row_idx][col] == GridPosition.Empty:
-        self._grid[row_idx][col] = color
-        return row_idx
-    print("Column is full, try another column!")
-    return -1
+    height = self._heights[col]
+    if height == self._n_rows:
+      print("Column is full, try another column!")
+      return -1
+    self._boards[color.value] |= 1 << (col * self._stride + height)
+    self._heights[col] = height + 1
+    row_idx = self._n_rows - 1 - height
+    self._update_runs(color, row_idx, col)
+    return row_idx
 
   def print_board(self) -> None:
     print("Board:")
     for row_idx in range(self._n_rows):
       this_row = []
       for col_idx in range(self._n_cols):
-        if self._grid[row_idx][col_idx] == GridPosition.Empty:
+        position = self._position_at(row_idx, col_idx)
+        if position == GridPosition.Empty:
           this_row.append('0')
-        elif self._grid[row_idx][col_idx] == GridPosition.Red:
+        elif position == GridPosition.Red:
           this_row.append('R')
-        elif self._grid[row_idx][col_idx] == GridPosition.Blue:
+        elif position == GridPosition.Blue:
           this_row.append('B')
         else:
-          raise Error("invalid value for grid[{}][{}]".format(
+          raise ValueError("invalid value for grid[{}][{}]".format(
               row_idx, col_idx))
       print(' '.join(this_row))
 
   def is_connected(self, color: GridPosition, n: int, row_idx: int,
                    col_idx: int) -> bool:
-    # connected by same column
-    if self._n_rows - row_idx >= n:
-      row_connected = True
-      for i in range(row_idx + 1, row_idx + n):
-        if self._grid[i][col_idx] != color:
-          row_connected = False
-          break
-      if row_connected:
+    board = self._boards[color.value]
+    bit = col_idx * self._stride + (self._n_rows - 1 - row_idx)
+    for shift in self._shifts:
+      # covered has a bit set on every cell that belongs to a run of n
+      covered = spread_runs(run_starts(board, shift, n), shift, n)
+      if (covered >> bit) & 1:
         return True
+    return False
 
-    # check by same row
-    count = 0
-    for j in range(self._n_cols):
-      if self._grid[row_idx][j] == color:
-        count += 1
-      else:
-        count = 0
-      if count == n:
+  def is_connected_incremental(self, color: GridPosition, n: int,
+                               row_idx: int, col_idx: int) -> bool:
+    "walk outward from (row_idx, col_idx) only, O(n) regardless of board size"
+    for d_row, d_col in DIRECTIONS:
+      length = 1 + self.count_run(color, row_idx, col_idx, d_row, d_col, n - 1)
+      if length < n:
+        length += self.count_run(color, row_idx, col_idx, -d_row, -d_col,
+                                 n - length)
+      if length >= n:
         return True
+    return False
 
-    # check by positive diagonal
+  def count_run(self, color: GridPosition, row_idx: int, col_idx: int,
+                d_row: int, d_col: int, limit: int) -> int:
+    "number of `color` pieces right after (row_idx, col_idx), at most limit"
     count = 0
-    for r in range(self._n_rows):
-      c = row_idx + col_idx - r
-      if c >= 0 and c < self._n_cols and self._grid[r][c] == color:
-        count += 1
+    while count < limit:
+      row_idx += d_row
+      col_idx += d_col
+      if not self._has_piece(color, row_idx, col_idx):
+        break
+      count += 1
+    return count
+
+  def _update_runs(self, color: GridPosition, row_idx: int,
+                   col_idx: int) -> None:
+    # the neighbours of a freshly filled cell are the end cells of their
+    # runs, so their cached lengths are exact
+    longest = 0
+    for run_lengths, (d_row, d_col) in zip(self._run_lengths, DIRECTIONS):
+      before = after = 0
+      if self._has_piece(color, row_idx - d_row, col_idx - d_col):
+        before = run_lengths[self._cell(row_idx - d_row, col_idx - d_col)]
+      if self._has_piece(color, row_idx + d_row, col_idx + d_col):
+        after = run_lengths[self._cell(row_idx + d_row, col_idx + d_col)]
+      length = before + 1 + after
+      run_lengths[self._cell(row_idx - before * d_row,
+                             col_idx - before * d_col)] = length
+      run_lengths[self._cell(row_idx + after * d_row,
+                             col_idx + after * d_col)] = length
+      run_lengths[self._cell(row_idx, col_idx)] = length
+      longest = max(longest, length)
+    self._last_run_length = longest
+
+  def _cell(self, row_idx: int, col_idx: int) -> int:
+    return row_idx * self._n_cols + col_idx
+
+  def _has_piece(self, color: GridPosition, row_idx: int,
+                 col_idx: int) -> bool:
+    if not (0 <= row_idx < self._n_rows and 0 <= col_idx < self._n_cols):
+      return False
+    bit = col_idx * self._stride + (self._n_rows - 1 - row_idx)
+    return bool((self._boards[color.value] >> bit) & 1)
+
+  def _position_at(self, row_idx: int, col_idx: int) -> GridPosition:
+    bit = col_idx * self._stride + (self._n_rows - 1 - row_idx)
+    for color in (GridPosition.Red, GridPosition.Blue):
+      if (self._boards[color.value] >> bit) & 1:
+        return color
+    return GridPosition.Empty
+
+
+def run_starts(board: int, shift: int, n: int) -> int:
+  "bits of `board` that start a run of n set bits spaced `shift` apart"
+  length = 1
+  while length < n:
+    step = min(length, n - length)
+    board &= board >> (shift * step)
+    length += step
+  return board
+
+
+def spread_runs(starts: int, shift: int, n: int) -> int:
+  "inverse of run_starts: mark all n cells of every run beginning in `starts`"
+  length = 1
+  while length < n:
+    step = min(length, n - length)
+    starts |= starts << (shift * step)
+    length += step
+  return starts
+
+
+class BatchGrid:
+  """Many boards of the same size, advanced in lockstep.
+
+  Board k lives in lane k of one big integer per color. Each lane holds
+  Grid's column layout followed by at least one empty padding column, so the
+  shift-and-AND run detection of Grid sweeps every board in a single pass and
+  a line can never continue from one lane into the next. Lanes are padded to
+  whole bytes so that moves can be assembled in a bytearray and finished
+  boards found by scanning bytes.
+  """
+
+  def __init__(self, n_boards: int, n_rows: int, n_cols: int,
+               connect_to_win: int) -> None:
+    self._n_boards = n_boards
+    self._n_rows = n_rows
+    self._n_cols = n_cols
+    self._connect_to_win = connect_to_win
+    self._stride = n_rows + 1
+    self._shifts = (1, self._stride, self._stride + 1, self._stride - 1)
+    self._lane_bytes = ((n_cols + 1) * self._stride + 7) // 8
+    self._lane_bits = self._lane_bytes * 8
+    self.reset()
+
+  def reset(self) -> None:
+    self._boards = [0] * len(GridPosition)  # indexed by GridPosition.value
+    self._heights = array('B', bytes(self._n_boards * self._n_cols))
+    self._moves = array('H', [0]) * self._n_boards
+    self._winners = bytearray(self._n_boards)  # GridPosition values
+    self._n_finished = 0
+
+  @property
+  def n_boards(self) -> int:
+    return self._n_boards
+
+  @property
+  def n_rows(self) -> int:
+    return self._n_rows
+
+  @property
+  def n_cols(self) -> int:
+    return self._n_cols
+
+  @property
+  def heights(self) -> array:
+    "flat (n_boards, n_cols) array of pieces per column"
+    return self._heights
+
+  @property
+  def all_finished(self) -> bool:
+    return self._n_finished == self._n_boards
+
+  def is_finished(self, board_idx: int) -> bool:
+    return (self._winners[board_idx] != GridPosition.Empty.value
+            or self._moves[board_idx] == self._n_rows * self._n_cols)
+
+  def winner(self, board_idx: int) -> GridPosition:
+    return GridPosition(self._winners[board_idx])
+
+  def column_height(self, board_idx: int, col: int) -> int:
+    return self._heights[board_idx * self._n_cols + col]
+
+  def grid(self, board_idx: int) -> List[List[GridPosition]]:
+    base = board_idx * self._lane_bits
+    rows = []
+    for row_idx in range(self._n_rows):
+      row = []
+      for col_idx in range(self._n_cols):
+        bit = base + col_idx * self._stride + (self._n_rows - 1 - row_idx)
+        position = GridPosition.Empty
+        for color in (GridPosition.Red, GridPosition.Blue):
+          if (self._boards[color.value] >> bit) & 1:
+            position = color
+        row.append(position)
+      rows.append(row)
+    return rows
+
+  def play(self, cols: Sequence[int], color: GridPosition) -> List[int]:
+    """Drop one `color` piece per board, cols[k] on board k.
+
+    Boards that are finished, or whose entry is -1, are skipped. Returns the
+    row of every piece placed, -1 where nothing was placed.
+    """
+    if color == GridPosition.Empty:
+      raise ValueError("Invalid piece color!")
+    if len(cols) != self._n_boards:
+      raise ValueError("Expected one column per board!")
+    moves = bytearray(self._n_boards * self._lane_bytes)
+    rows = [-1] * self._n_boards
+    heights = self._heights
+    n_cells = self._n_rows * self._n_cols
+    for board_idx, col in enumerate(cols):
+      if (col < 0 or self._winners[board_idx]
+          or self._moves[board_idx] == n_cells):
+        continue
+      if col >= self._n_cols:
+        raise ValueError("Invalid column!")
+      cell = board_idx * self._n_cols + col
+      height = heights[cell]
+      if height == self._n_rows:
+        continue
+      heights[cell] = height + 1
+      self._moves[board_idx] += 1
+      if self._moves[board_idx] == n_cells:
+        self._n_finished += 1
+      bit = board_idx * self._lane_bits + col * self._stride + height
+      moves[bit >> 3] |= 1 << (bit & 7)
+      rows[board_idx] = self._n_rows - 1 - height
+    self._boards[color.value] |= int.from_bytes(moves, 'little')
+    self._record_finished(color)
+    return rows
+
+  def _record_finished(self, color: GridPosition) -> None:
+    board = self._boards[color.value]
+    runs = 0
+    for shift in self._shifts:
+      runs |= run_starts(board, shift, self._connect_to_win)
+    # boards stop at their first line, so any lane with a line and no winner
+    # yet was won by this move
+    data = runs.to_bytes(self._n_boards * self._lane_bytes, 'little')
+    n_cells = self._n_rows * self._n_cols
+    for match in re.finditer(rb'[^\x00]', data):
+      board_idx = match.start() // self._lane_bytes
+      if self._winners[board_idx] == GridPosition.Empty.value:
+        self._winners[board_idx] = color.value
+        if self._moves[board_idx] != n_cells:  # full boards are counted
+          self._n_finished += 1
+
+
+class SearchResult:
+  "outcome and statistics of one Solver.solve call"
+
+  def __init__(self, best_col: int, score: int, depth: int, exact: bool,
+               nodes: int, elapsed: float, tt_probes: int,
+               tt_hits: int) -> None:
+    self._best_col = best_col
+    self._score = score
+    self._depth = depth
+    self._exact = exact
+    self._nodes = nodes
+    self._elapsed = elapsed
+    self._tt_probes = tt_probes
+    self._tt_hits = tt_hits
+
+  @property
+  def best_col(self) -> int:
+    return self._best_col
+
+  @property
+  def score(self) -> int:
+    "> 0 the side to move wins, < 0 it loses; larger means sooner"
+    return self._score
+
+  @property
+  def depth(self) -> int:
+    return self._depth
+
+  @property
+  def exact(self) -> bool:
+    "True if the score is proven rather than cut off by the depth limit"
+    return self._exact
+
+  @property
+  def nodes(self) -> int:
+    return self._nodes
+
+  @property
+  def elapsed(self) -> float:
+    return self._elapsed
+
+  @property
+  def nodes_per_second(self) -> float:
+    return self._nodes / self._elapsed if self._elapsed > 0 else 0.0
+
+  @property
+  def tt_hit_rate(self) -> float:
+    return self._tt_hits / self._tt_probes if self._tt_probes else 0.0
+
+  def __repr__(self) -> str:
+    return ('SearchResult(best_col={}, score={}, depth={}, exact={}, '
+            'nodes={}, nodes/sec={:.0f}, tt_hit_rate={:.2%})'.format(
+                self._best_col, self._score, self._depth, self._exact,
+                self._nodes, self.nodes_per_second, self.tt_hit_rate))
+
+
+class _SearchTimeout(Exception):
+  pass
+
+
+class Solver:
+  """Negamax with alpha-beta pruning over Grid-compatible bitboards.
+
+  Positions are searched as (current, mask): the stones of the side to move
+  and all stones, in the same column layout as Grid. A win found with m
+  stones on the board scores (n_rows * n_cols + 1 - m) // 2, so quicker wins
+  score higher, and a score of 0 is a draw or not yet decided.
+
+  Searches deepen iteratively until the position is proven or the time
+  budget runs out, always keeping the best move of the last finished depth.
+  Every search shares a fixed-size, Zobrist-hashed transposition table.
+  """
+
+  _EXACT, _LOWER, _UPPER = 0, 1, 2
+  _TIME_CHECK_INTERVAL = 1024
+
+  def __init__(self, n_rows: int, n_cols: int, connect_to_win: int,
+               tt_bits: int = 20, time_budget: float = 1.0,
+               seed: int = 0) -> None:
+    self._n_rows = n_rows
+    self._n_cols = n_cols
+    self._connect_to_win = connect_to_win
+    self._time_budget = time_budget
+    self._cells = n_rows * n_cols
+    stride = n_rows + 1
+    self._shifts = (1, stride, stride + 1, stride - 1)
+    self._bottom = [1 << (col * stride) for col in range(n_cols)]
+    self._top = [1 << (col * stride + n_rows - 1) for col in range(n_cols)]
+    self._column_mask = [((1 << n_rows) - 1) << (col * stride)
+                         for col in range(n_cols)]
+    self._board_mask = sum(self._column_mask)
+    self._bottom_mask = sum(self._bottom)
+    center = (n_cols - 1) / 2
+    self._order = sorted(range(n_cols), key=lambda col: abs(col - center))
+
+    rng = random.Random(seed)
+    n_bits = n_cols * stride
+    self._zobrist = [[rng.getrandbits(64) for _ in range(n_bits)]
+                     for _ in range(2)]
+    self._turn_keys = [rng.getrandbits(64) for _ in range(2)]
+    self._tt_mask = (1 << tt_bits) - 1
+    self._table = [None] * (1 << tt_bits)
+    self._generation = 0
+
+  @property
+  def time_budget(self) -> float:
+    return self._time_budget
+
+  def best_move(self, grid: Grid, color: GridPosition) -> int:
+    return self.solve(grid, color).best_col
+
+  def solve(self, grid: Grid, color: GridPosition,
+            max_depth: Optional[int] = None) -> SearchResult:
+    if color == GridPosition.Empty:
+      raise ValueError("Invalid piece color!")
+    if (grid.n_rows, grid.n_cols) != (self._n_rows, self._n_cols):
+      raise ValueError("Grid does not match the solver dimensions!")
+    other = GridPosition.Blue if color == GridPosition.Red else GridPosition.Red
+    current = grid.bitboard(color)
+    mask = current | grid.bitboard(other)
+    side = color.value - 1
+    return self.solve_position(current, mask, side,
+                               self.position_hash(current, mask, side),
+                               max_depth)
+
+  def position_hash(self, current: int, mask: int, side: int) -> int:
+    "Zobrist key of a raw position; `side` is 0 for Red, 1 for Blue"
+    key = self._turn_keys[side]
+    for stones, stone_side in ((current, side), (mask ^ current, 1 - side)):
+      for bit in range(len(self._zobrist[0])):
+        if (stones >> bit) & 1:
+          key ^= self._zobrist[stone_side][bit]
+    return key
+
+  def solve_position(self, current: int, mask: int, side: int, key: int,
+                     max_depth: Optional[int] = None) -> SearchResult:
+    "search a raw (current, mask) position; `side` is 0 for Red, 1 for Blue"
+    moves = bin(mask).count('1')
+    remaining = self._cells - moves
+    if max_depth is None or max_depth > remaining:
+      max_depth = remaining
+    self._generation += 1
+    self._nodes = self._tt_probes = self._tt_hits = 0
+    start = time.perf_counter()
+    self._deadline = start + self._time_budget
+
+    legal = [col for col in self._order if self._can_play(mask, col)]
+    if not legal:
+      raise ValueError("No legal moves left!")
+    best_col, score, searched, exact = legal[0], 0, 0, False
+    for col in legal:
+      if self._is_winning_move(current, mask, col):
+        best_col, score, exact = col, (self._cells + 1 - moves) // 2, True
+        break
+    else:
+      # depth-limited searches double their depth so that a usable move is
+      # ready early; the last one runs to the end of the game
+      depth = 1
+      while True:
+        depth = min(depth, max_depth)
+        try:
+          if depth == remaining:
+            col, score = self._solve_exact(current, mask, moves, side, key,
+                                           legal, best_col)
+          else:
+            col, score = self._search_root(current, mask, moves, side, key,
+                                           depth, legal, -self._cells,
+                                           self._cells)
+        except _SearchTimeout:
+          break
+        best_col, searched = col, depth
+        exact = score != 0 or depth == remaining
+        if exact or depth == max_depth:
+          break
+        depth *= 2
+    return SearchResult(best_col, score, searched, exact, self._nodes,
+                        time.perf_counter() - start, self._tt_probes,
+                        self._tt_hits)
+
+  def _solve_exact(self, current: int, mask: int, moves: int, side: int,
+                   key: int, legal: List[int],
+                   best_col: int) -> Tuple[int, int]:
+    "narrow the exact score with null-window searches to the end of the game"
+    low = -((self._cells - moves) // 2)
+    high = (self._cells - 1 - moves) // 2
+    depth = self._cells - moves
+    while low < high:
+      # probe closer to zero first: results near a draw are the most common
+      med = low + (high - low) // 2
+      if med <= 0 and low // 2 < med:
+        med = low // 2
+      elif med >= 0 and high // 2 > med:
+        med = high // 2
+      col, score = self._search_root(current, mask, moves, side, key, depth,
+                                     legal, med, med + 1)
+      if score > med:
+        low, best_col = score, col
       else:
-        count = 0
-      if count == n:
-        return True
+        high = score
+    return best_col, low
 
-    # check by negative diagonal
-    count = 0
-    for r in range(self._n_rows):
-      c = -row_idx + col_idx + r
-      if c >= 0 and c < self._n_cols and self._grid[r][c] == color:
-        count += 1
+  def _search_root(self, current: int, mask: int, moves: int, side: int,
+                   key: int, depth: int, legal: List[int], alpha: int,
+                   beta: int) -> Tuple[int, int]:
+    entry = self._table[key & self._tt_mask]
+    if entry is not None and entry[0] == key and entry[5] in legal:
+      legal = [entry[5]] + [col for col in legal if col != entry[5]]
+    opponent_wins = self._winning_cells(current ^ mask, mask)
+    original_alpha = alpha
+    best_score, best_col = -self._cells, legal[0]
+    for col in legal:
+      move = (mask + self._bottom[col]) & self._column_mask[col]
+      score = -self._negamax(
+          current ^ mask, mask | move, moves + 1, 1 - side,
+          self._child_key(key, side, move), -beta, -alpha, depth - 1,
+          opponent_wins & ~move,
+          self._winning_cells(current | move, mask | move))
+      if score > best_score:
+        best_score, best_col = score, col
+      if score > alpha:
+        alpha = score
+      if alpha >= beta:
+        break
+    self._store(key, depth, self._flag(best_score, original_alpha, beta),
+                best_score, best_col, moves)
+    return best_col, best_score
+
+  def _negamax(self, current: int, mask: int, moves: int, side: int, key: int,
+               alpha: int, beta: int, depth: int, own_wins: int,
+               opponent_wins: Optional[int]) -> int:
+    # own_wins/opponent_wins are the winning cells of the side to move and of
+    # its opponent. The parent derives them while ordering its moves, so a
+    # leaf never has to compute any.
+    self._nodes += 1
+    if (self._nodes % self._TIME_CHECK_INTERVAL == 0
+        and time.perf_counter() > self._deadline):
+      raise _SearchTimeout()
+    if moves == self._cells:
+      return 0
+    playable = (mask + self._bottom_mask) & self._board_mask
+    if own_wins & playable:
+      return (self._cells + 1 - moves) // 2
+    if depth == 0:
+      return 0
+
+    # a threat is a cell where the opponent would win on their next turn; we
+    # have to block it and must not play right underneath any other
+    if opponent_wins is None:
+      opponent_wins = self._winning_cells(current ^ mask, mask)
+    threats = opponent_wins & playable
+    if threats & (threats - 1):
+      return -((self._cells - moves) // 2)
+    safe = (threats or playable) & ~(opponent_wins >> 1)
+    if not safe:
+      return -((self._cells - moves) // 2)
+
+    upper = (self._cells - 1 - moves) // 2
+    if beta > upper:
+      beta = upper
+      if alpha >= beta:
+        return beta
+
+    original_alpha = alpha
+    table_move = -1
+    self._tt_probes += 1
+    entry = self._table[key & self._tt_mask]
+    if entry is not None and entry[0] == key:
+      self._tt_hits += 1
+      table_move = entry[5]
+      if entry[1] <= depth <= entry[2]:
+        flag, value = entry[3], entry[4]
+        if flag == self._EXACT:
+          return value
+        if flag == self._LOWER and value > alpha:
+          alpha = value
+        elif flag == self._UPPER and value < beta:
+          beta = value
+        if alpha >= beta:
+          return value
+
+    candidates = []
+    for col in self._order:
+      move = (mask + self._bottom[col]) & self._column_mask[col]
+      if not move & safe:
+        continue
+      # children that search on need our winning cells anyway, so use them to
+      # try the moves that leave us the most winning cells first
+      strength, our_wins = 0, None
+      if depth > 1:
+        our_wins = self._winning_cells(current | move, mask | move)
+        strength = bin(our_wins).count('1')
+      if col == table_move:
+        strength += self._cells
+      candidates.append((strength, col, move, our_wins))
+    candidates.sort(key=lambda candidate: -candidate[0])
+
+    best_score, best_col = -self._cells, -1
+    for _, col, move, our_wins in candidates:
+      score = -self._negamax(current ^ mask, mask | move, moves + 1, 1 - side,
+                             self._child_key(key, side, move), -beta, -alpha,
+                             depth - 1, opponent_wins & ~move, our_wins)
+      if score > best_score:
+        best_score, best_col = score, col
+      if score > alpha:
+        alpha = score
+      if alpha >= beta:
+        break
+
+    self._store(key, depth, self._flag(best_score, original_alpha, beta),
+                best_score, best_col, moves)
+    return best_score
+
+  def _child_key(self, key: int, side: int, move: int) -> int:
+    return (key ^ self._zobrist[side][move.bit_length() - 1]
+            ^ self._turn_keys[0] ^ self._turn_keys[1])
+
+  def _flag(self, score: int, alpha: int, beta: int) -> int:
+    if score <= alpha:
+      return self._UPPER
+    if score >= beta:
+      return self._LOWER
+    return self._EXACT
+
+  def _store(self, key: int, depth: int, flag: int, score: int, col: int,
+             moves: int) -> None:
+    # Entries hold for a range of search depths. A heuristic score answers
+    # any shallower search too. A won or lost score holds for every search
+    # deep enough to reach the final stone, and for no shallower one: reusing
+    # it there would mix a result from past the horizon with horizon scores.
+    min_depth, max_depth = 0, depth
+    if ((flag != self._UPPER and score > 0)
+        or (flag != self._LOWER and score < 0)):
+      min_depth = self._cells + 1 - 2 * abs(score) - moves
+      max_depth = self._cells
+    # depth-preferred replacement; entries left by older searches always yield
+    slot = key & self._tt_mask
+    entry = self._table[slot]
+    if (entry is None or entry[6] != self._generation or entry[0] == key
+        or max_depth >= entry[2]):
+      self._table[slot] = (key, min_depth, max_depth, flag, score, col,
+                           self._generation)
+
+  def _can_play(self, mask: int, col: int) -> bool:
+    return not mask & self._top[col]
+
+  def _is_winning_move(self, current: int, mask: int, col: int) -> bool:
+    move = (mask + self._bottom[col]) & self._column_mask[col]
+    return bool(self._winning_cells(current, mask) & move)
+
+  def _winning_cells(self, current: int, mask: int) -> int:
+    "empty cells that would complete a line of connect_to_win for `current`"
+    if self._connect_to_win == 4:
+      return self._winning_cells_connect_four(current, mask)
+    n = self._connect_to_win
+    board = self._board_mask
+    cells = 0
+    for shift in self._shifts:
+      # runs[k] marks the cells that start a run of k stones along shift
+      runs = [-1, current]  # -1: the empty run, every cell qualifies
+      for length in range(2, n):
+        runs.append(runs[-1] & (current >> ((length - 1) * shift)))
+      # an empty cell wins if `before` stones end right below it and the
+      # remaining n - 1 - before stones start right above it
+      for before in range(n):
+        cells |= (runs[before] << (before * shift)) & (runs[n - 1 - before]
+                                                       >> shift)
+    return cells & board & ~mask
+
+  def _winning_cells_connect_four(self, current: int, mask: int) -> int:
+    "_winning_cells unrolled for the classic game, where it dominates search"
+    # only a line from above can end on top of a column
+    cells = (current << 1) & (current << 2) & (current << 3)
+    for shift in self._shifts[1:]:
+      pair = (current << shift) & (current << 2 * shift)
+      cells |= pair & (current << 3 * shift)
+      cells |= pair & (current >> shift)
+      pair = (current >> shift) & (current >> 2 * shift)
+      cells |= pair & (current << shift)
+      cells |= pair & (current >> 3 * shift)
+    return cells & self._board_mask & ~mask
+
+
+class OpeningBook:
+  """Read-only opening book, memory-mapped and searched in place.
+
+  The file is a header followed by fixed-width records sorted by canonical
+  position key, so a lookup is a binary search over the mapping and never
+  loads the book into memory. A position key is current + mask + bottom row
+  in Grid's column layout, which is unique per position; the canonical key is
+  the smaller of the key and that of the mirrored board, and best moves are
+  stored for the canonical side.
+  """
+
+  MAGIC = b'C4OB'
+  VERSION = 1
+  _HEADER = struct.Struct('<4sBBBBI')  # magic, version, rows, cols, n, count
+  _RECORD = struct.Struct('<QbBBB')  # key, score, best_col, depth, exact
+
+  def __init__(self, path: str) -> None:
+    self._file = open(path, 'rb')
+    self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+    (magic, version, self._n_rows, self._n_cols, self._connect_to_win,
+     self._count) = self._HEADER.unpack_from(self._data, 0)
+    if magic != self.MAGIC or version != self.VERSION:
+      self.close()
+      raise ValueError("Not an opening book: {}".format(path))
+    self._stride = self._n_rows + 1
+    self._bottom_mask = sum(1 << (col * self._stride)
+                            for col in range(self._n_cols))
+
+  def __enter__(self) -> 'OpeningBook':
+    return self
+
+  def __exit__(self, *exc_info) -> None:
+    self.close()
+
+  def __len__(self) -> int:
+    return self._count
+
+  def close(self) -> None:
+    self._data.close()
+    self._file.close()
+
+  def lookup(self, grid: Grid, color: GridPosition) -> Optional[SearchResult]:
+    "the stored result for `color` to move on `grid`, or None if not in book"
+    if (grid.n_rows, grid.n_cols) != (self._n_rows, self._n_cols):
+      return None
+    other = GridPosition.Blue if color == GridPosition.Red else GridPosition.Red
+    current = grid.bitboard(color)
+    return self.lookup_position(current, current | grid.bitboard(other))
+
+  def lookup_position(self, current: int, mask: int) -> Optional[SearchResult]:
+    start = time.perf_counter()
+    key = current + mask + self._bottom_mask
+    mirrored = mirror_columns(key, self._n_rows, self._n_cols)
+    canonical = min(key, mirrored)
+    low, high = 0, self._count
+    offset = self._HEADER.size
+    size = self._RECORD.size
+    while low < high:
+      middle = (low + high) // 2
+      (middle_key,) = struct.unpack_from('<Q', self._data,
+                                         offset + middle * size)
+      if middle_key < canonical:
+        low = middle + 1
       else:
-        count = 0
-      if count == n:
-        return True
+        high = middle
+    if low == self._count:
+      return None
+    found_key, score, best_col, depth, exact = self._RECORD.unpack_from(
+        self._data, offset + low * size)
+    if found_key != canonical:
+      return None
+    if canonical != key:
+      best_col = self._n_cols - 1 - best_col
+    return SearchResult(best_col, score, depth, bool(exact), 0,
+                        time.perf_counter() - start, 0, 0)
 
-    return False
+
+def mirror_columns(board: int, n_rows: int, n_cols: int) -> int:
+  "reflect a board in Grid's column layout left to right"
+  stride = n_rows + 1
+  column = (1 << stride) - 1
+  mirrored = 0
+  for col in range(n_cols):
+    mirrored |= ((board >> (col * stride)) & column) << (
+        (n_cols - 1 - col) * stride)
+  return mirrored
+
+
+def build_opening_book(path: str, n_rows: int, n_cols: int,
+                       connect_to_win: int, max_depth: int,
+                       time_budget: float = 1.0, tt_bits: int = 20) -> int:
+  """Solve every position up to max_depth plies and write them to `path`.
+
+  Mirror images are stored once. Positions the solver cannot prove within
+  time_budget keep its best move and are marked inexact. Returns the number
+  of positions written.
+  """
+  stride = n_rows + 1
+  if n_cols * stride > 64:
+    raise ValueError("Board too large for 64-bit position keys!")
+  solver = Solver(n_rows, n_cols, connect_to_win, tt_bits=tt_bits,
+                  time_budget=time_budget)
+  bottom_mask = sum(1 << (col * stride) for col in range(n_cols))
+  column_masks = [((1 << n_rows) - 1) << (col * stride)
+                  for col in range(n_cols)]
+  records = {}
+  level = [(0, 0)]  # (current, mask) with the side to move in current
+  for depth in range(max_depth + 1):
+    next_level = []
+    for current, mask in level:
+      key = current + mask + bottom_mask
+      canonical = min(key, mirror_columns(key, n_rows, n_cols))
+      if canonical in records:
+        continue
+      side = depth % 2
+      result = solver.solve_position(current, mask, side,
+                                     solver.position_hash(current, mask, side))
+      best_col = result.best_col
+      if canonical != key:
+        best_col = n_cols - 1 - best_col
+      records[canonical] = (result.score, best_col, result.depth,
+                            int(result.exact))
+      for col_mask, bottom in zip(column_masks, (1 << (col * stride)
+                                                 for col in range(n_cols))):
+        move = (mask + bottom) & col_mask
+        if not move:
+          continue
+        if any(run_starts(current | move, shift, connect_to_win)
+               for shift in (1, stride, stride + 1, stride - 1)):
+          continue  # the game ends here, nothing to book after it
+        if bin(mask | move).count('1') < n_rows * n_cols:
+          next_level.append((current ^ mask, mask | move))
+    level = next_level
+
+  with open(path, 'wb') as book_file:
+    book_file.write(OpeningBook._HEADER.pack(
+        OpeningBook.MAGIC, OpeningBook.VERSION, n_rows, n_cols,
+        connect_to_win, len(records)))
+    for key in sorted(records):
+      book_file.write(OpeningBook._RECORD.pack(key, *records[key]))
+  return len(records)
 
 
 class Player:
@@ -117,15 +865,33 @@ class Player:
     return self._name
 
 
+class AIPlayer(Player):
+
+  def __init__(self, name: str, color: GridPosition, solver: Solver,
+               book: Optional[OpeningBook] = None) -> None:
+    super().__init__(name, color)
+    self._solver = solver
+    self._book = book
+
+  def choose_column(self, grid: Grid) -> int:
+    if self._book is not None:
+      entry = self._book.lookup(grid, self._color)
+      if entry is not None:
+        return entry.best_col
+    return self._solver.best_move(grid, self._color)
+
+
 class Game:
 
   def __init__(self, board_rows: int, board_cols: int, target_score: int,
-               connect_to_win: int) -> None:
+               connect_to_win: int,
+               players: Optional[List[Player]] = None) -> None:
     self._grid = Grid(board_rows, board_cols)
     self._max_moves = board_rows * board_cols
-    self._players = []
-    self._players.append(Player("Player 1", GridPosition.Red))
-    self._players.append(Player("Player 2", GridPosition.Blue))
+    if players is None:
+      players = [Player("Player 1", GridPosition.Red),
+                 Player("Player 2", GridPosition.Blue)]
+    self._players = players
     self._target_score = target_score
     self._connect_to_win = connect_to_win
     self._score = {}
@@ -133,6 +899,11 @@ class Game:
       self._score[player.name] = 0
 
   def play_move(self, player: Player) -> Tuple[int, int]:
+    if isinstance(player, AIPlayer):
+      col_idx = player.choose_column(self._grid)
+      row_idx = self._grid.place_piece(col_idx, player.color)
+      print("{} plays column {}".format(player.name, col_idx))
+      return (row_idx, col_idx)
     while True:
       self._grid.print_board()
       try:
@@ -150,9 +921,8 @@ class Game:
   def play_one_match(self) -> Optional[Player]:
     for _ in range(self._max_moves):
       for player in self._players:
-        row_idx, col_idx = self.play_move(player)
-        if self._grid.is_connected(player.color, self._connect_to_win, row_idx,
-                                   col_idx):
+        self.play_move(player)
+        if self._grid.last_run_length >= self._connect_to_win:
           self._score[player.name] += 1
           return player
     return None
@@ -167,5 +937,272 @@ class Game:
     print('Final winner: {}'.format(round_winner.name))
 
 
-game = Game(6, 7, 2, 4)
-game.play_game()
+class MovePolicy(ABC):
+  "picks a column for headless play; must only return columns that fit"
+
+  def __init__(self, seed: Optional[int] = None) -> None:
+    self._rng = random.Random(seed)
+
+  def reseed(self, seed: int) -> None:
+    self._rng.seed(seed)
+
+  @abstractmethod
+  def choose_column(self, grid: Grid, color: GridPosition,
+                    connect_to_win: int) -> int:
+    pass
+
+  def _legal_columns(self, grid: Grid) -> List[int]:
+    return [col for col in range(grid.n_cols)
+            if grid.column_height(col) < grid.n_rows]
+
+
+class RandomPolicy(MovePolicy):
+
+  def choose_column(self, grid: Grid, color: GridPosition,
+                    connect_to_win: int) -> int:
+    return self._rng.choice(self._legal_columns(grid))
+
+
+class GreedyPolicy(MovePolicy):
+  "win if possible, otherwise block the opponent, otherwise play randomly"
+
+  def choose_column(self, grid: Grid, color: GridPosition,
+                    connect_to_win: int) -> int:
+    legal = self._legal_columns(grid)
+    other = GridPosition.Blue if color == GridPosition.Red else GridPosition.Red
+    for player in (color, other):
+      for col in legal:
+        if self._wins_with(grid, player, col, connect_to_win):
+          return col
+    return self._rng.choice(legal)
+
+  def _wins_with(self, grid: Grid, color: GridPosition, col: int,
+                 connect_to_win: int) -> bool:
+    stride = grid.n_rows + 1
+    board = grid.bitboard(color) | 1 << (col * stride + grid.column_height(col))
+    return any(run_starts(board, shift, connect_to_win)
+               for shift in (1, stride, stride + 1, stride - 1))
+
+
+class SolverPolicy(MovePolicy):
+  "plays Solver.best_move; the solver is built lazily in each worker process"
+
+  def __init__(self, time_budget: float = 0.05, tt_bits: int = 16,
+               seed: Optional[int] = None,
+               book_path: Optional[str] = None) -> None:
+    super().__init__(seed)
+    self._time_budget = time_budget
+    self._tt_bits = tt_bits
+    self._book_path = book_path
+    self._solver = None
+    self._book = None
+
+  def __getstate__(self):
+    # never ship a populated transposition table or a mapping to the workers
+    state = self.__dict__.copy()
+    state['_solver'] = None
+    state['_book'] = None
+    return state
+
+  def choose_column(self, grid: Grid, color: GridPosition,
+                    connect_to_win: int) -> int:
+    if self._book_path is not None:
+      if self._book is None:
+        self._book = OpeningBook(self._book_path)
+      entry = self._book.lookup(grid, color)
+      if entry is not None:
+        return entry.best_col
+    if self._solver is None:
+      self._solver = Solver(grid.n_rows, grid.n_cols, connect_to_win,
+                            tt_bits=self._tt_bits,
+                            time_budget=self._time_budget)
+    return self._solver.best_move(grid, color)
+
+
+class MatchRecord:
+  "one headless game: the columns played, the winner and the number of moves"
+
+  def __init__(self, moves: bytes, winner: GridPosition) -> None:
+    self._moves = moves
+    self._winner = winner
+
+  @property
+  def moves(self) -> bytes:
+    return self._moves
+
+  @property
+  def winner(self) -> GridPosition:
+    return self._winner
+
+  @property
+  def length(self) -> int:
+    return len(self._moves)
+
+  def to_line(self) -> str:
+    "compact text form, e.g. '3344552 1': columns played, then the winner"
+    return '{} {}'.format(''.join(str(col) for col in self._moves)
+                          if all(col < 10 for col in self._moves)
+                          else ','.join(str(col) for col in self._moves),
+                          self._winner.value)
+
+
+def play_headless_match(n_rows: int, n_cols: int, connect_to_win: int,
+                        red_policy: MovePolicy,
+                        blue_policy: MovePolicy) -> MatchRecord:
+  grid = Grid(n_rows, n_cols)
+  players = ((GridPosition.Red, red_policy), (GridPosition.Blue, blue_policy))
+  moves = bytearray()
+  for turn in range(n_rows * n_cols):
+    color, policy = players[turn % 2]
+    col = policy.choose_column(grid, color, connect_to_win)
+    grid.place_piece(col, color)
+    moves.append(col)
+    if grid.last_run_length >= connect_to_win:
+      return MatchRecord(bytes(moves), color)
+  return MatchRecord(bytes(moves), GridPosition.Empty)
+
+
+def _play_headless_chunk(n_rows: int, n_cols: int, connect_to_win: int,
+                         red_policy: MovePolicy, blue_policy: MovePolicy,
+                         seed: int, first_game: int,
+                         n_games: int) -> List[MatchRecord]:
+  records = []
+  for game_idx in range(first_game, first_game + n_games):
+    # every game gets its own seeds, so results do not depend on chunking
+    red_policy.reseed(hash((seed, game_idx, 0)))
+    blue_policy.reseed(hash((seed, game_idx, 1)))
+    records.append(play_headless_match(n_rows, n_cols, connect_to_win,
+                                       red_policy, blue_policy))
+  return records
+
+
+class SelfPlayRunner:
+  """Plays many headless games across a process pool.
+
+  Games are handed out in chunks so that every task does enough work to hide
+  the cost of shipping the policies and results between processes; records
+  are yielded as soon as their chunk completes.
+  """
+
+  def __init__(self, n_rows: int, n_cols: int, connect_to_win: int,
+               red_policy: MovePolicy, blue_policy: MovePolicy,
+               workers: Optional[int] = None, chunk_size: int = 64) -> None:
+    self._n_rows = n_rows
+    self._n_cols = n_cols
+    self._connect_to_win = connect_to_win
+    self._red_policy = red_policy
+    self._blue_policy = blue_policy
+    self._workers = workers or os.cpu_count() or 1
+    self._chunk_size = chunk_size
+    self._games_played = 0
+    self._elapsed = 0.0
+
+  @property
+  def games_played(self) -> int:
+    return self._games_played
+
+  @property
+  def games_per_second(self) -> float:
+    return self._games_played / self._elapsed if self._elapsed > 0 else 0.0
+
+  def run(self, n_games: int, seed: int = 0) -> Iterator[MatchRecord]:
+    start = time.perf_counter()
+    self._games_played = 0
+    with ProcessPoolExecutor(max_workers=self._workers) as executor:
+      futures = [
+          executor.submit(_play_headless_chunk, self._n_rows, self._n_cols,
+                          self._connect_to_win, self._red_policy,
+                          self._blue_policy, seed, first_game,
+                          min(self._chunk_size, n_games - first_game))
+          for first_game in range(0, n_games, self._chunk_size)
+      ]
+      for future in as_completed(futures):
+        for record in future.result():
+          self._games_played += 1
+          self._elapsed = time.perf_counter() - start
+          yield record
+
+
+def check_incremental_wins(n_games: int = 50, seed: int = 0,
+                           sizes: Sequence[Tuple[int, int]] = ((6, 7), (4, 4),
+                                                               (3, 9), (20, 20))
+                           ) -> None:
+  """raises ValueError unless is_connected_incremental and last_run_length
+  agree with the full is_connected scan after every move of random games"""
+  colors = (GridPosition.Red, GridPosition.Blue)
+  rng = random.Random(seed)
+  for game_idx in range(n_games):
+    n_rows, n_cols = sizes[game_idx % len(sizes)]
+    grid = Grid(n_rows, n_cols)
+    for turn in range(n_rows * n_cols):
+      color = colors[turn % 2]
+      legal = [col for col in range(n_cols)
+               if grid.column_height(col) < n_rows]
+      col_idx = rng.choice(legal)
+      row_idx = grid.place_piece(col_idx, color)
+      longest = max(1 + grid.count_run(color, row_idx, col_idx, d_row, d_col,
+                                       n_rows + n_cols)
+                    + grid.count_run(color, row_idx, col_idx, -d_row, -d_col,
+                                     n_rows + n_cols)
+                    for d_row, d_col in DIRECTIONS)
+      if grid.last_run_length != longest:
+        raise ValueError('Game {} move {}: last_run_length {} != {}'.format(
+            game_idx, turn, grid.last_run_length, longest))
+      for n in range(2, 8):
+        full = grid.is_connected(color, n, row_idx, col_idx)
+        incremental = grid.is_connected_incremental(color, n, row_idx,
+                                                    col_idx)
+        if full != incremental or full != (grid.last_run_length >= n):
+          raise ValueError(
+              'Game {} move {} connect {}: full scan {}, incremental {}, '
+              'run length {}'.format(game_idx, turn, n, full, incremental,
+                                     grid.last_run_length))
+
+
+def benchmark_batch_grid(n_boards: int = 4096, n_rows: int = 6,
+                         n_cols: int = 7, connect_to_win: int = 4,
+                         seed: int = 0) -> Tuple[float, float]:
+  "random games per second played one Grid at a time and as one BatchGrid"
+  colors = (GridPosition.Red, GridPosition.Blue)
+  rng = random.Random(seed)
+  start = time.perf_counter()
+  for _ in range(n_boards):
+    grid = Grid(n_rows, n_cols)
+    for turn in range(n_rows * n_cols):
+      legal = [col for col in range(n_cols)
+               if grid.column_height(col) < n_rows]
+      grid.place_piece(rng.choice(legal), colors[turn % 2])
+      if grid.last_run_length >= connect_to_win:
+        break
+  scalar_rate = n_boards / (time.perf_counter() - start)
+
+  rng = random.Random(seed)
+  start = time.perf_counter()
+  batch = BatchGrid(n_boards, n_rows, n_cols, connect_to_win)
+  heights = batch.heights
+  turn = 0
+  while not batch.all_finished:
+    cols = []
+    for board_idx in range(n_boards):
+      if batch.is_finished(board_idx):
+        cols.append(-1)
+        continue
+      base = board_idx * n_cols
+      cols.append(rng.choice([col for col in range(n_cols)
+                              if heights[base + col] < n_rows]))
+    batch.play(cols, colors[turn % 2])
+    turn += 1
+  batch_rate = n_boards / (time.perf_counter() - start)
+
+  print('Grid: {:.0f} games/sec, BatchGrid: {:.0f} games/sec ({:.1f}x)'.format(
+      scalar_rate, batch_rate, batch_rate / scalar_rate))
+  return scalar_rate, batch_rate
+
+
+if __name__ == '__main__':
+  if sys.argv[1:] == ['--check']:
+    check_incremental_wins()
+    print('incremental win detection agrees with the full scan')
+  else:
+    game = Game(6, 7, 2, 4)
+    game.play_game()
@@ -1,7 +1,14 @@
 from enum import Enum
 from abc import ABC, abstractmethod
-from typing import Union, List
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from typing import Union, List, Optional, Tuple
+import asyncio
+import json
+import math
+import os
 import random
+import time
 
 
 class Suit(Enum):
@@ -26,37 +33,171 @@ class Card:
     def __repr__(self) -> str:
         return 'Card(suit={}, value={})'.format(self.suit, self.value)
     
+# Cards never change, so every deck and shoe shares these 52 instances.
+# A card code is its index here: suit index * 13 + rank - 1.
+CARD_POOL = tuple(Card(suit, min(10, rank)) for suit in Suit for rank in range(1, 14))
+CARD_VALUES = bytes(card.value for card in CARD_POOL)
+
+
 class Deck:
     def __init__(self):
-        self._cards = []
-        for suit in Suit:
-            for value in range(1, 14):
-                self._cards.append(Card(suit, min(10, value)))
+        self._cards = list(CARD_POOL)
     
     def draw(self) -> Card:
         return self._cards.pop()
     
     def shuffle(self) -> None:
-        for i in range(len(self._cards)):
-            j = random.randint(0, len(self._cards) - 1)
-            self._cards[i], self._cards[j] = self._cards[j], self._cards[i]
+        random.shuffle(self._cards)
+
+
+class Shoe:
+    """Several decks dealt from one buffer of card codes.
+
+    Each draw swaps a uniformly chosen undealt card into the next slot, which
+    is a Fisher-Yates shuffle done one card at a time. Reshuffling therefore
+    only rewinds to the start of the buffer, whatever order it is left in.
+    """
+    def __init__(self, num_decks: int = 6, penetration: float = 0.75, seed: Union[int, str, None] = None) -> None:
+        if num_decks < 1:
+            raise ValueError('A shoe needs at least one deck')
+        if not 0 < penetration <= 1:
+            raise ValueError('Penetration should be in (0, 1]')
+        self._codes = array('B', range(len(CARD_POOL))) * num_decks
+        self._position = 0
+        self._cut_card = int(len(self._codes) * penetration)
+        self._rng = random.Random(seed)
+
+    @property
+    def cards_remaining(self) -> int:
+        return len(self._codes) - self._position
+
+    @property
+    def needs_shuffle(self) -> bool:
+        return self._position >= self._cut_card
+
+    def draw_code(self) -> int:
+        position = self._position
+        if position == len(self._codes):
+            raise ValueError('Shoe is empty')
+        codes = self._codes
+        j = self._rng.randrange(position, len(codes))
+        codes[position], codes[j] = codes[j], codes[position]
+        self._position = position + 1
+        return codes[position]
+
+    def draw(self) -> Card:
+        return CARD_POOL[self.draw_code()]
+
+    def shuffle(self) -> None:
+        "like at a casino table, a shoe is only reshuffled once the cut card is out"
+        if self.needs_shuffle:
+            self.reshuffle()
+
+    def reshuffle(self) -> None:
+        self._position = 0
+
+
+# A hand's future only depends on its best total and on whether an ace is
+# counted as 11 in it (soft), so both pack into one small key, total * 2 + soft.
+# Every bust hand shares BUST_KEY. The strategy and memo tables use this key.
+BUST = 22
+BUST_KEY = BUST * 2
+NATURAL_KEY = 21 * 2 + 1
+
+
+def _build_hand_transitions() -> bytes:
+    "indexed by key * 11 + card value, holds the key after drawing that card"
+    table = bytearray([BUST_KEY]) * (32 * 2 * 11)
+    for total in range(BUST):
+        for soft in (0, 1):
+            hard = total - 10 if soft else total
+            if hard < 0:
+                continue
+            for value in range(1, 11):
+                next_hard = hard + value
+                if next_hard > 21:
+                    continue
+                next_soft = (soft or value == 1) and next_hard <= 11
+                table[(total * 2 + soft) * 11 + value] = (next_hard + 10 if next_soft else next_hard) * 2 + next_soft
+    return bytes(table)
+
+
+HAND_TRANSITIONS = _build_hand_transitions()
+
+
+class HandState:
+    "hard total, aces held, card count and pair flag of a hand, each updated in O(1) per card"
+    __slots__ = ('_hard_total', '_aces', '_card_count', '_first_value', '_is_pair')
+
+    def __init__(self) -> None:
+        self._hard_total = 0
+        self._aces = 0
+        self._card_count = 0
+        self._first_value = 0
+        self._is_pair = False
+
+    def add(self, value: int) -> None:
+        self._hard_total += value
+        self._aces += value == 1
+        self._card_count += 1
+        if self._card_count == 1:
+            self._first_value = value
+        self._is_pair = self._card_count == 2 and value == self._first_value
+
+    @property
+    def hard_total(self) -> int:
+        return self._hard_total
+
+    @property
+    def aces(self) -> int:
+        return self._aces
+
+    @property
+    def card_count(self) -> int:
+        return self._card_count
+
+    @property
+    def is_pair(self) -> bool:
+        return self._is_pair
+
+    @property
+    def is_soft(self) -> bool:
+        "one ace can still count as 11"
+        return self._aces > 0 and self._hard_total <= 11
+
+    @property
+    def total(self) -> int:
+        return self._hard_total + 10 if self.is_soft else self._hard_total
+
+    @property
+    def is_bust(self) -> bool:
+        return self._hard_total > 21
+
+    @property
+    def is_blackjack(self) -> bool:
+        return self._card_count == 2 and self.total == 21
+
+    @property
+    def key(self) -> int:
+        return BUST_KEY if self.is_bust else self.total * 2 + self.is_soft
 
 
 class Hand:
     def __init__(self):
         self._cards = []
-        self._score = 0
+        self._state = HandState()
 
     def add_card(self, card: Card) -> None:
         self._cards.append(card)
-        self._score += card.value
-        if card.value == 1 and self.score <= 11:
-            self._score += 10
-        # print('Score: {}'.format(self._score))
+        self._state.add(card.value)
 
     @property
     def score(self) -> int:
-        return self._score
+        return self._state.total
+
+    @property
+    def state(self) -> HandState:
+        return self._state
     
     @property
     def cards(self) -> List[Card]:
@@ -126,11 +267,11 @@ class Dealer(Player):
             raise ValueError("input should be a positive integer smaller than 22.")
     
     def make_move(self) -> bool:
-        return self._get_hand().score < self._target_score
+        return self.hand.score < self._target_score
     
 
 class Game:
-    def __init__(self, customer: CustomerPlayer, dealer: Dealer, deck: Deck) -> None:
+    def __init__(self, customer: CustomerPlayer, dealer: Dealer, deck: Union[Deck, Shoe]) -> None:
         self._customer = customer
         self._dealer = dealer
         self._deck = deck
@@ -152,6 +293,9 @@ class Game:
     def play_round(self, bet_amount: Union[int, float]):
         self._customer.place_bet(bet_amount)
         self._deck.shuffle()
+        if isinstance(self._deck, Shoe) and self._deck.cards_remaining < MAX_CARDS_PER_ROUND:
+            # a cut card placed deep in the shoe can leave too few cards to finish a round
+            self._deck.reshuffle()
 
         self.give_initial_cards()
 
@@ -178,7 +322,9 @@ class Game:
         self.cleanup_round()
     
     def cleanup_round(self):
-        self._deck = Deck()
+        # a shoe stays in play until its cut card comes out
+        if not isinstance(self._deck, Shoe):
+            self._deck = Deck()
         self._customer.clear_hand()
         self._dealer.clear_hand()
         print('Player balance: ', self._customer.balance)
@@ -209,7 +355,555 @@ class Game:
         print("You can leave with {}".format(self._customer.balance))
 
 
-player = CustomerPlayer(Hand(), 1000)
-dealer = Dealer(Hand())
+# Headless simulation. Hands are tracked by their HandState key and advanced
+# through HAND_TRANSITIONS. Policies are flat byte tables holding 1 where the
+# hand should draw.
+MAX_CARDS_PER_ROUND = 24  # no player or dealer hand can take more than 11
+
+
+def dealer_policy(target_score: int = 17, hit_soft_target: bool = False) -> bytes:
+    "indexed by hand key"
+    table = bytearray(32 * 2)
+    for total in range(32):
+        for soft in (0, 1):
+            table[total * 2 + soft] = total < target_score or (
+                hit_soft_target and soft and total == target_score)
+    return bytes(table)
+
+
+def threshold_player_policy(stand_on: int = 17) -> bytes:
+    "indexed by hand key * 11 + dealer up card value"
+    table = bytearray(32 * 2 * 11)
+    for total in range(min(stand_on, 32)):
+        for soft in (0, 1):
+            for up_card in range(1, 11):
+                table[(total * 2 + soft) * 11 + up_card] = 1
+    return bytes(table)
+
+
+def simulate_hands(n_hands: int, player_policy: bytes, dealer_policy: bytes, num_decks: int = 6,
+                   penetration: float = 0.75, blackjack_payout: float = 1.5,
+                   seed: Union[int, str, None] = None) -> Tuple[int, float, float]:
+    "play n_hands at one unit each; returns (hands, sum of payoffs, sum of squared payoffs)"
+    shoe = Shoe(num_decks, penetration, seed)
+    draw = shoe.draw_code
+    values = CARD_VALUES
+    transitions = HAND_TRANSITIONS
+    payoff_sum = payoff_square_sum = 0.0
+    for _ in range(n_hands):
+        if shoe.needs_shuffle or shoe.cards_remaining < MAX_CARDS_PER_ROUND:
+            shoe.reshuffle()
+        first, up_card, second, hole_card = values[draw()], values[draw()], values[draw()], values[draw()]
+        player = transitions[transitions[first] * 11 + second]
+        dealer = transitions[transitions[up_card] * 11 + hole_card]
+
+        if player == NATURAL_KEY or dealer == NATURAL_KEY:
+            if player == dealer:
+                payoff = 0.0
+            else:
+                payoff = blackjack_payout if player == NATURAL_KEY else -1.0
+        else:
+            while player_policy[player * 11 + up_card]:
+                player = transitions[player * 11 + values[draw()]]
+            if player == BUST_KEY:
+                payoff = -1.0
+            else:
+                while dealer_policy[dealer]:
+                    dealer = transitions[dealer * 11 + values[draw()]]
+                if dealer == BUST_KEY or player >> 1 > dealer >> 1:
+                    payoff = 1.0
+                elif player >> 1 < dealer >> 1:
+                    payoff = -1.0
+                else:
+                    payoff = 0.0
+        payoff_sum += payoff
+        payoff_square_sum += payoff * payoff
+    return n_hands, payoff_sum, payoff_square_sum
+
+
+class SimulationReport:
+    def __init__(self, hands: int, payoff_sum: float, payoff_square_sum: float, elapsed: float) -> None:
+        self._hands = hands
+        self._expected_value = payoff_sum / hands
+        variance = max(payoff_square_sum / hands - self._expected_value ** 2, 0.0)
+        self._std_error = math.sqrt(variance / hands)
+        self._elapsed = elapsed
+
+    @property
+    def hands(self) -> int:
+        return self._hands
+
+    @property
+    def expected_value(self) -> float:
+        "average payoff per unit bet, from the player's side"
+        return self._expected_value
+
+    @property
+    def std_error(self) -> float:
+        return self._std_error
+
+    def confidence_interval(self, z: float = 1.96) -> Tuple[float, float]:
+        return (self._expected_value - z * self._std_error, self._expected_value + z * self._std_error)
+
+    @property
+    def hands_per_second(self) -> float:
+        return self._hands / self._elapsed if self._elapsed > 0 else 0.0
+
+    def __repr__(self) -> str:
+        low, high = self.confidence_interval()
+        return 'SimulationReport(hands={}, ev={:+.5f}, 95% ci=[{:+.5f}, {:+.5f}], hands/sec={:.0f})'.format(
+            self._hands, self._expected_value, low, high, self.hands_per_second)
+
+
+class MonteCarloSimulator:
+    """Prices a set of house rules by simulating hands across a process pool.
+
+    Work is split into chunks; each chunk plays with its own shoe and a random
+    stream seeded from (seed, chunk index), so a run is reproducible and does not
+    depend on how many workers share it.
+    """
+    def __init__(self, player_policy: bytes, dealer_policy: bytes, num_decks: int = 6,
+                 penetration: float = 0.75, blackjack_payout: float = 1.5) -> None:
+        self._player_policy = player_policy
+        self._dealer_policy = dealer_policy
+        self._num_decks = num_decks
+        self._penetration = penetration
+        self._blackjack_payout = blackjack_payout
+
+    def run(self, n_hands: int, workers: Optional[int] = None, seed: int = 0,
+            chunk_size: int = 100000) -> SimulationReport:
+        start = time.perf_counter()
+        hands = 0
+        payoff_sum = payoff_square_sum = 0.0
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(simulate_hands, min(chunk_size, n_hands - first_hand),
+                                       self._player_policy, self._dealer_policy, self._num_decks,
+                                       self._penetration, self._blackjack_payout,
+                                       '{}:{}'.format(seed, first_hand // chunk_size))
+                       for first_hand in range(0, n_hands, chunk_size)]
+            for future in futures:
+                chunk_hands, chunk_sum, chunk_square_sum = future.result()
+                hands += chunk_hands
+                payoff_sum += chunk_sum
+                payoff_square_sum += chunk_square_sum
+        return SimulationReport(hands, payoff_sum, payoff_square_sum, time.perf_counter() - start)
+
+
+
+# Exact analysis. A shoe composition is a tuple of 10 card counts, where index
+# value - 1 holds how many cards of that value are left (aces first, tens last).
+# Dealer outcomes are indexed by final total, with BUST as the last slot.
+
+
+BUSTED = (0.0,) * BUST + (1.0,)
+
+
+def shoe_counts(num_decks: int = 6) -> Tuple[int, ...]:
+    return (4 * num_decks,) * 9 + (16 * num_decks,)
+
+
+def _remove_card(counts: Tuple[int, ...], value: int) -> Tuple[int, ...]:
+    if not counts[value - 1]:
+        raise ValueError('No card of value {} left'.format(value))
+    return counts[:value - 1] + (counts[value - 1] - 1,) + counts[value:]
+
+
+class DealerOutcomeSolver:
+    """Exact distribution of the dealer's final total for a given up card and shoe.
+
+    Draws are enumerated recursively without replacement, memoized on
+    (hand key, remaining counts).
+    """
+    def __init__(self, target_score: int = 17, hit_soft_target: bool = False, peek: bool = True) -> None:
+        self._policy = dealer_policy(target_score, hit_soft_target)
+        self._peek = peek
+        self._memo = {}
+
+    def outcomes(self, up_card: int, counts: Tuple[int, ...]) -> Tuple[float, ...]:
+        """counts is the shoe before the up card is dealt; with peek the dealer is known
+        not to hold a natural, as the hand would already be over otherwise"""
+        counts = _remove_card(counts, up_card)
+        excluded = 0
+        if self._peek and up_card == 1:
+            excluded = 10
+        elif self._peek and up_card == 10:
+            excluded = 1
+        remaining = sum(counts) - (counts[excluded - 1] if excluded else 0)
+        result = [0.0] * (BUST + 1)
+        for value in range(1, 11):
+            n = counts[value - 1]
+            if not n or value == excluded:
+                continue
+            p = n / remaining
+            key = HAND_TRANSITIONS[HAND_TRANSITIONS[up_card] * 11 + value]
+            finals = self._finish(key, _remove_card(counts, value))
+            for total, q in enumerate(finals):
+                if q:
+                    result[total] += p * q
+        return tuple(result)
+
+    def _finish(self, key: int, counts: Tuple[int, ...]) -> Tuple[float, ...]:
+        memo_key = (key, counts)
+        cached = self._memo.get(memo_key)
+        if cached is not None:
+            return cached
+        result = [0.0] * (BUST + 1)
+        if not self._policy[key]:
+            result[key >> 1] = 1.0
+        else:
+            remaining = sum(counts)
+            for value in range(1, 11):
+                n = counts[value - 1]
+                if not n:
+                    continue
+                next_key = HAND_TRANSITIONS[key * 11 + value]
+                finals = self._finish(next_key, _remove_card(counts, value)) if next_key != BUST_KEY else BUSTED
+                for final_total, q in enumerate(finals):
+                    if q:
+                        result[final_total] += n / remaining * q
+        result = tuple(result)
+        self._memo[memo_key] = result
+        return result
+
+
+class BasicStrategySolver:
+    """Hit/stand basic strategy for CustomerPlayer against a rule set.
+
+    Dealer outcomes are exact for the shoe less the up card. The player's own
+    draws are taken from that same composition, which makes the strategy
+    total-dependent, as printed basic-strategy charts are. The resulting table
+    uses the threshold_player_policy layout and can be fed to the simulator.
+    Results are cached in a JSON file, keyed by the rules, when cache_path is set.
+    """
+    def __init__(self, num_decks: int = 6, target_score: int = 17, hit_soft_target: bool = False,
+                 cache_path: Optional[str] = None) -> None:
+        self._num_decks = num_decks
+        self._target_score = target_score
+        self._hit_soft_target = hit_soft_target
+        self._cache_path = cache_path
+        self._dealer_outcomes = None
+        self._player_policy = None
+
+    @property
+    def rules_key(self) -> str:
+        return 'decks={};target={};h17={}'.format(self._num_decks, self._target_score, int(self._hit_soft_target))
+
+    def dealer_outcomes(self, up_card: int) -> Tuple[float, ...]:
+        self._solve()
+        return self._dealer_outcomes[up_card]
+
+    def player_policy(self) -> bytes:
+        self._solve()
+        return self._player_policy
+
+    def should_hit(self, total: int, soft: bool, up_card: int) -> bool:
+        return bool(self.player_policy()[(total * 2 + soft) * 11 + up_card])
+
+    def _solve(self) -> None:
+        if self._player_policy is not None or self._load_cache():
+            return
+        solver = DealerOutcomeSolver(self._target_score, self._hit_soft_target)
+        counts = shoe_counts(self._num_decks)
+        self._dealer_outcomes = {}
+        table = bytearray(32 * 2 * 11)
+        for up_card in range(1, 11):
+            outcomes = solver.outcomes(up_card, counts)
+            self._dealer_outcomes[up_card] = outcomes
+            remaining = _remove_card(counts, up_card)
+            draw_odds = [n / sum(remaining) for n in remaining]
+            memo = {}
+            for total in range(4, 22):
+                for soft in (0, 1):
+                    if soft and total < 12:
+                        continue
+                    key = total * 2 + soft
+                    hit = self._hit_value(key, outcomes, draw_odds, memo)
+                    table[key * 11 + up_card] = hit > self._stand_value(key, outcomes)
+        self._player_policy = bytes(table)
+        self._save_cache()
+
+    @staticmethod
+    def _stand_value(key: int, outcomes: Tuple[float, ...]) -> float:
+        total = key >> 1
+        win = outcomes[BUST] + sum(outcomes[:total])
+        lose = sum(outcomes[total + 1:BUST])
+        return win - lose
+
+    def _hit_value(self, key: int, outcomes: Tuple[float, ...], draw_odds: List[float], memo: dict) -> float:
+        if key in memo:
+            return memo[key]
+        value = 0.0
+        for card, p in enumerate(draw_odds, 1):
+            next_key = HAND_TRANSITIONS[key * 11 + card]
+            if next_key == BUST_KEY:
+                value -= p
+            else:
+                value += p * max(self._stand_value(next_key, outcomes),
+                                 self._hit_value(next_key, outcomes, draw_odds, memo))
+        memo[key] = value
+        return value
+
+    def _load_cache(self) -> bool:
+        if self._cache_path is None or not os.path.exists(self._cache_path):
+            return False
+        with open(self._cache_path) as f:
+            entry = json.load(f).get(self.rules_key)
+        if entry is None:
+            return False
+        self._dealer_outcomes = {int(up_card): tuple(outcomes)
+                                 for up_card, outcomes in entry['dealer_outcomes'].items()}
+        self._player_policy = bytes.fromhex(entry['player_policy'])
+        return True
+
+    def _save_cache(self) -> None:
+        if self._cache_path is None:
+            return
+        cache = {}
+        if os.path.exists(self._cache_path):
+            with open(self._cache_path) as f:
+                cache = json.load(f)
+        cache[self.rules_key] = {
+            'dealer_outcomes': {str(up_card): list(outcomes) for up_card, outcomes in self._dealer_outcomes.items()},
+            'player_policy': self._player_policy.hex(),
+        }
+        with open(self._cache_path, 'w') as f:
+            json.dump(cache, f)
+
+
+# Networked play. Many tables share one event loop; a table asks each seat for
+# its decisions through awaitable requests, so a slow or absent client only
+# costs that seat its timeout (it then stands) and never blocks other tables.
+class DecisionRequest:
+    def __init__(self, hand: Hand, up_card: Card, future: asyncio.Future) -> None:
+        self._hand = hand
+        self._up_card = up_card
+        self._future = future
+
+    @property
+    def hand(self) -> Hand:
+        return self._hand
+
+    @property
+    def up_card(self) -> Card:
+        return self._up_card
+
+    def respond(self, hit: bool) -> None:
+        "answers arriving after the timeout are ignored"
+        if not self._future.done():
+            self._future.set_result(hit)
+
+
+class Seat:
+    def __init__(self, player: CustomerPlayer, bet: Union[int, float]) -> None:
+        self._player = player
+        self._bet = bet
+        self._requests = asyncio.Queue()
+
+    @property
+    def player(self) -> CustomerPlayer:
+        return self._player
+
+    @property
+    def bet(self) -> Union[int, float]:
+        return self._bet
+
+    async def next_request(self) -> Optional[DecisionRequest]:
+        "None once the table has closed"
+        return await self._requests.get()
+
+    def request(self, up_card: Card) -> asyncio.Future:
+        "queue a hit-or-stand question about the seat's hand, answered through the returned future"
+        future = asyncio.get_running_loop().create_future()
+        self._requests.put_nowait(DecisionRequest(self._player.hand, up_card, future))
+        return future
+
+    def close(self) -> None:
+        "tell the player no more requests are coming"
+        self._requests.put_nowait(None)
+
+
+class AsyncTable:
+    def __init__(self, shoe: Shoe, decision_timeout: float = 5.0, blackjack_payout: float = 1.5) -> None:
+        self._shoe = shoe
+        self._dealer = Dealer(Hand())
+        self._decision_timeout = decision_timeout
+        self._blackjack_payout = blackjack_payout
+        self._seats = []
+        self._latencies = []
+        self._timeouts = 0
+        self._hands_played = 0
+
+    @property
+    def seats(self) -> List[Seat]:
+        return self._seats
+
+    @property
+    def latencies(self) -> List[float]:
+        "seconds from each decision request until its answer, for answered requests"
+        return self._latencies
+
+    @property
+    def timeouts(self) -> int:
+        return self._timeouts
+
+    @property
+    def hands_played(self) -> int:
+        return self._hands_played
+
+    def join(self, player: CustomerPlayer, bet: Union[int, float]) -> Seat:
+        seat = Seat(player, bet)
+        self._seats.append(seat)
+        return seat
+
+    async def run(self, n_rounds: int) -> None:
+        try:
+            for _ in range(n_rounds):
+                await self.play_round()
+        finally:
+            for seat in self._seats:
+                seat.close()
+
+    async def play_round(self) -> None:
+        active = [seat for seat in self._seats if seat.player.balance >= seat.bet]
+        if self._shoe.needs_shuffle or self._shoe.cards_remaining < MAX_CARDS_PER_ROUND * (len(active) + 1):
+            self._shoe.reshuffle()
+        for seat in active:
+            seat.player.clear_hand()
+            seat.player.place_bet(seat.bet)
+        self._dealer.clear_hand()
+        for _ in range(2):
+            for seat in active:
+                seat.player.add_card(self._shoe.draw())
+            self._dealer.add_card(self._shoe.draw())
+
+        dealer_hand = self._dealer.hand
+        if not dealer_hand.state.is_blackjack:
+            up_card = dealer_hand.cards[0]
+            for seat in active:
+                hand = seat.player.hand
+                while hand.score < 21 and await self._ask(seat, up_card):
+                    seat.player.add_card(self._shoe.draw())
+            if any(not seat.player.hand.state.is_bust for seat in active):
+                while self._dealer.make_move():
+                    self._dealer.add_card(self._shoe.draw())
+
+        for seat in active:
+            self._settle(seat)
+        self._hands_played += len(active)
+
+    async def _ask(self, seat: Seat, up_card: Card) -> bool:
+        future = seat.request(up_card)
+        start = time.perf_counter()
+        try:
+            hit = await asyncio.wait_for(future, self._decision_timeout)
+        except asyncio.TimeoutError:
+            self._timeouts += 1
+            return False
+        self._latencies.append(time.perf_counter() - start)
+        return hit
+
+    def _settle(self, seat: Seat) -> None:
+        player, dealer = seat.player.hand.state, self._dealer.hand.state
+        if player.is_blackjack and not dealer.is_blackjack:
+            seat.player.receive_winnings(seat.bet * (1 + self._blackjack_payout))
+        elif player.is_bust or dealer.is_blackjack and not player.is_blackjack:
+            return
+        elif dealer.is_bust or player.total > dealer.total:
+            seat.player.receive_winnings(seat.bet * 2)
+        elif player.total == dealer.total:
+            seat.player.receive_winnings(seat.bet)
+
+
+class TableServer:
+    def __init__(self, decision_timeout: float = 5.0) -> None:
+        self._decision_timeout = decision_timeout
+        self._tables = []
+
+    @property
+    def tables(self) -> List[AsyncTable]:
+        return self._tables
+
+    def open_table(self, num_decks: int = 6, seed: Union[int, str, None] = None) -> AsyncTable:
+        table = AsyncTable(Shoe(num_decks, seed=seed), self._decision_timeout)
+        self._tables.append(table)
+        return table
+
+    async def run(self, n_rounds: int) -> None:
+        await asyncio.gather(*(table.run(n_rounds) for table in self._tables))
+
+
+class LoadTestReport:
+    def __init__(self, latencies: List[float], timeouts: int, hands: int, elapsed: float) -> None:
+        self._latencies = sorted(latencies)
+        self._timeouts = timeouts
+        self._hands = hands
+        self._elapsed = elapsed
+
+    @property
+    def decisions(self) -> int:
+        return len(self._latencies)
+
+    @property
+    def timeouts(self) -> int:
+        return self._timeouts
+
+    @property
+    def hands(self) -> int:
+        return self._hands
+
+    @property
+    def hands_per_second(self) -> float:
+        return self._hands / self._elapsed if self._elapsed > 0 else 0.0
+
+    def latency_percentile(self, percent: float) -> float:
+        if not self._latencies:
+            return 0.0
+        rank = min(len(self._latencies) - 1, int(len(self._latencies) * percent / 100))
+        return self._latencies[rank]
+
+    def __repr__(self) -> str:
+        return ('LoadTestReport(hands={}, decisions={}, timeouts={}, p50={:.2f}ms, p90={:.2f}ms, '
+                'p99={:.2f}ms, hands/sec={:.0f})').format(
+            self._hands, self.decisions, self._timeouts, self.latency_percentile(50) * 1000,
+            self.latency_percentile(90) * 1000, self.latency_percentile(99) * 1000, self.hands_per_second)
+
+
+async def _bot(seat: Seat, player_policy: bytes, think_time: float, rng: random.Random) -> None:
+    while True:
+        request = await seat.next_request()
+        if request is None:
+            return
+        if think_time:
+            await asyncio.sleep(rng.uniform(0, 2 * think_time))
+        request.respond(bool(player_policy[request.hand.state.key * 11 + request.up_card.value]))
+
+
+def load_test(n_tables: int = 100, seats_per_table: int = 7, n_rounds: int = 100, think_time: float = 0.0,
+              decision_timeout: float = 1.0, player_policy: Optional[bytes] = None, seed: int = 0) -> LoadTestReport:
+    "plays n_rounds at every table with bots in all seats, all on one event loop"
+    if player_policy is None:
+        player_policy = threshold_player_policy()
+
+    async def main() -> float:
+        rng = random.Random(seed)
+        bots = []
+        for table_id in range(n_tables):
+            table = server.open_table(seed='{}:{}'.format(seed, table_id))
+            for _ in range(seats_per_table):
+                seat = table.join(CustomerPlayer(Hand(), 1000), 1)
+                bots.append(_bot(seat, player_policy, think_time, rng))
+        start = time.perf_counter()
+        await asyncio.gather(server.run(n_rounds), *bots)
+        return time.perf_counter() - start
+
+    server = TableServer(decision_timeout)
+    elapsed = asyncio.run(main())
+    return LoadTestReport([latency for table in server.tables for latency in table.latencies],
+                          sum(table.timeouts for table in server.tables),
+                          sum(table.hands_played for table in server.tables), elapsed)
+
+if __name__ == '__main__':
+    player = CustomerPlayer(Hand(), 1000)
+    dealer = Dealer(Hand())
 
-Game(player, dealer, Deck()).play()
\ No newline at end of file
+    Game(player, dealer, Shoe()).play()
@@ -1,28 +1,145 @@
-from typing import List
+from bisect import bisect_left, insort
+from enum import Enum
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+import csv
 import datetime
+import mmap
+import os
+import random
+import struct
+import threading
+import time
+import tracemalloc
+
+
+class VehicleRegistry:
+    """Struct-of-arrays storage for the vehicles parked in one garage, one row per vehicle id.
+
+    Rows hold the size, the garage floor (-1 when not on a floor), the first
+    spot taken on a floor (-1 when not parked) and the hour it was parked (-1
+    when not billed). A row is bound to a vehicle when it parks and released
+    when it leaves, after which its id is handed to the next vehicle. Handing
+    out and releasing ids is locked, since gate threads park and leave at once.
+    """
+    def __init__(self) -> None:
+        self._sizes = array('B')
+        self._floors = array('i')
+        self._spot_starts = array('i')
+        self._park_times = array('q')
+        self._free_ids = []
+        self._lock = threading.Lock()
+
+    @property
+    def sizes(self) -> array:
+        return self._sizes
+
+    @property
+    def floors(self) -> array:
+        return self._floors
+
+    @property
+    def spot_starts(self) -> array:
+        return self._spot_starts
+
+    @property
+    def park_times(self) -> array:
+        return self._park_times
+
+    @property
+    def nbytes(self) -> int:
+        columns = (self._sizes, self._floors, self._spot_starts, self._park_times)
+        return sum(column.buffer_info()[1] * column.itemsize for column in columns)
+
+    def __len__(self) -> int:
+        return len(self._sizes) - len(self._free_ids)
+
+    def add(self, vehicle: 'Vehicle') -> int:
+        "binds the vehicle to a free row and returns its id; raises ValueError if it is already parked"
+        with self._lock:
+            if vehicle._registry is not None:
+                raise ValueError("Vehicle is already parked!")
+            if self._free_ids:
+                vehicle_id = self._free_ids.pop()
+                self._sizes[vehicle_id] = vehicle.size
+            else:
+                vehicle_id = len(self._sizes)
+                self._sizes.append(vehicle.size)
+                self._floors.append(-1)
+                self._spot_starts.append(-1)
+                self._park_times.append(-1)
+            vehicle._registry = self
+            vehicle._vehicle_id = vehicle_id
+            return vehicle_id
+
+    def release(self, vehicle: 'Vehicle') -> None:
+        "unbinds the vehicle and frees its row for the next vehicle that parks"
+        with self._lock:
+            if vehicle._registry is not self:
+                raise ValueError("Vehicle not in the registry!")
+            vehicle_id = vehicle._vehicle_id
+            self._floors[vehicle_id] = self._spot_starts[vehicle_id] = self._park_times[vehicle_id] = -1
+            self._free_ids.append(vehicle_id)
+            vehicle._registry = None
+            vehicle._vehicle_id = -1
 
 
 class Vehicle:
+    "a size plus, while parked, a view over its row in the garage's VehicleRegistry"
+    __slots__ = ('_size', '_vehicle_id', '_registry')
+
     def __init__(self, size: int):
         self._size = size
+        self._vehicle_id = -1
+        self._registry = None
+
+    @property
+    def vehicle_id(self) -> int:
+        "the row in the registry of the garage it is parked in, -1 when not parked"
+        return self._vehicle_id
+
+    @property
+    def registry(self) -> Optional[VehicleRegistry]:
+        return self._registry
 
     @property
     def size(self) -> int:
         return self._size
+
+    @property
+    def floor(self) -> int:
+        return -1 if self._registry is None else self._registry.floors[self._vehicle_id]
+
+    @property
+    def spot_start(self) -> int:
+        return -1 if self._registry is None else self._registry.spot_starts[self._vehicle_id]
+
+    @property
+    def park_time(self) -> int:
+        return -1 if self._registry is None else self._registry.park_times[self._vehicle_id]
     
 class Car(Vehicle):
+    __slots__ = ()
+
     def __init__(self):
         super().__init__(size=1)
 
 class Limo(Vehicle):
+    __slots__ = ()
+
     def __init__(self):
         super().__init__(size=2)
 
 class Truck(Vehicle):
+    __slots__ = ()
+
     def __init__(self):
         super().__init__(size=3)
 
 class Driver:
+    __slots__ = ('_vehicle', '_id', '_payment_due')
+
     def __init__(self, vehicle: Vehicle, driver_id: int) -> None:
         self._vehicle = vehicle
         self._id = driver_id
@@ -40,102 +157,1012 @@ class Driver:
         self._payment_due += price
 
 
+class Placement(Enum):
+    FIRST_FIT = 'first_fit'  # lowest numbered spot that fits
+    BEST_FIT = 'best_fit'    # shortest free run that fits, leaving long runs for big vehicles
+
+
+class FreeRunIndex:
+    """Free spots of a floor, indexed for O(log n) placement.
+
+    A segment tree over the spots keeps, per node, the free run touching its
+    left edge, the one touching its right edge and the longest one inside it,
+    which finds the first fit. Free runs are also kept by start and by end so
+    releasing spots can merge with both neighbours, and bucketed by length
+    (with the distinct lengths sorted) for best fit.
+    """
+    def __init__(self, capacity: int) -> None:
+        self._capacity = capacity
+        size = 1
+        while size < capacity:
+            size *= 2
+        self._size = size
+        self._prefix = [0] * (2 * size)
+        self._suffix = [0] * (2 * size)
+        self._best = [0] * (2 * size)
+        for spot in range(capacity):
+            self._prefix[size + spot] = self._suffix[size + spot] = self._best[size + spot] = 1
+        for node in range(size - 1, 0, -1):
+            self._pull(node, size >> node.bit_length())
+        self._run_end = {}    # start -> end (exclusive) of each free run
+        self._run_start = {}  # end (exclusive) -> start
+        self._lengths = []    # sorted distinct run lengths
+        self._starts_by_length = {}
+        self._free_spots = 0
+        if capacity:
+            self._add_run(0, capacity)
+
+    @property
+    def capacity(self) -> int:
+        return self._capacity
+
+    @property
+    def free_spots(self) -> int:
+        return self._free_spots
+
+    @property
+    def largest_free_run(self) -> int:
+        return self._best[1]
+
+    def is_occupied(self, spot: int) -> bool:
+        return not self._best[self._size + spot]
+
+    def first_fit(self, size: int) -> Optional[int]:
+        if size < 1 or self._best[1] < size:
+            return None
+        node, offset, half = 1, 0, self._size // 2
+        while node < self._size:
+            left, right = 2 * node, 2 * node + 1
+            if self._best[left] >= size:
+                node = left
+            elif self._suffix[left] + self._prefix[right] >= size:
+                return offset + half - self._suffix[left]
+            else:
+                node = right
+                offset += half
+            half //= 2
+        return offset
+
+    def best_fit(self, size: int) -> Optional[int]:
+        i = bisect_left(self._lengths, max(size, 1))
+        if i == len(self._lengths):
+            return None
+        return next(iter(self._starts_by_length[self._lengths[i]]))
+
+    def occupy(self, start: int, size: int) -> None:
+        if not 0 <= start < self._capacity or self.is_occupied(start):
+            raise ValueError('Spot {} is not free'.format(start))
+        run_start = self._free_run_start(start)
+        run_end = self._run_end[run_start]
+        if start + size > run_end:
+            raise ValueError('Spots {} to {} are not free'.format(start, start + size - 1))
+        self._remove_run(run_start)
+        if run_start < start:
+            self._add_run(run_start, start)
+        if start + size < run_end:
+            self._add_run(start + size, run_end)
+        for spot in range(start, start + size):
+            self._set_spot(spot, 0)
+
+    def release(self, start: int, size: int) -> None:
+        if start < 0 or start + size > self._capacity or not all(
+                self.is_occupied(spot) for spot in range(start, start + size)):
+            raise ValueError('Spots {} to {} are not occupied'.format(start, start + size - 1))
+        for spot in range(start, start + size):
+            self._set_spot(spot, 1)
+        run_start, run_end = start, start + size
+        if run_start in self._run_start:
+            run_start = self._run_start[run_start]
+            self._remove_run(run_start)
+        if run_end in self._run_end:
+            next_end = self._run_end[run_end]
+            self._remove_run(run_end)
+            run_end = next_end
+        self._add_run(run_start, run_end)
+
+    def _free_run_start(self, spot: int) -> int:
+        "walks up from the leaf; everything between the current node's start and spot is free"
+        node, length = self._size + spot, 1
+        while node > 1:
+            if node & 1:
+                sibling = node - 1
+                if self._suffix[sibling] < length:
+                    sibling_end = (node * length) - self._size
+                    return sibling_end - self._suffix[sibling]
+            node //= 2
+            length *= 2
+        return 0
+
+    def _set_spot(self, spot: int, free: int) -> None:
+        node = self._size + spot
+        self._prefix[node] = self._suffix[node] = self._best[node] = free
+        node //= 2
+        half = 1
+        while node:
+            self._pull(node, half)
+            node //= 2
+            half *= 2
+
+    def _pull(self, node: int, half: int) -> None:
+        left, right = 2 * node, 2 * node + 1
+        prefix, suffix = self._prefix, self._suffix
+        prefix[node] = prefix[left] if prefix[left] < half else half + prefix[right]
+        suffix[node] = suffix[right] if suffix[right] < half else half + suffix[left]
+        self._best[node] = max(self._best[left], self._best[right], suffix[left] + prefix[right])
+
+    def _add_run(self, start: int, end: int) -> None:
+        self._run_end[start] = end
+        self._run_start[end] = start
+        length = end - start
+        bucket = self._starts_by_length.get(length)
+        if bucket is None:
+            bucket = self._starts_by_length[length] = {}
+            insort(self._lengths, length)
+        bucket[start] = None
+        self._free_spots += length
+
+    def _remove_run(self, start: int) -> None:
+        end = self._run_end.pop(start)
+        del self._run_start[end]
+        length = end - start
+        bucket = self._starts_by_length[length]
+        del bucket[start]
+        if not bucket:
+            del self._starts_by_length[length]
+            del self._lengths[bisect_left(self._lengths, length)]
+        self._free_spots -= length
+
+
 class ParkingFloor:
-    def __init__(self, capacity: int):
+    def __init__(self, capacity: int, placement: Placement = Placement.FIRST_FIT,
+                 registry: Optional[VehicleRegistry] = None):
         self._capacity = capacity
-        self._occupancy_map = {}
-        self._is_occupied = [False] * capacity
+        self._placement = placement
+        self._registry = registry if registry is not None else VehicleRegistry()
+        self._parked = {}  # vehicle id -> vehicle; spots live in the registry
+        self._free_runs = FreeRunIndex(capacity)
     
     @property
     def capacity(self) -> int:
         return self._capacity
+
+    @property
+    def registry(self) -> VehicleRegistry:
+        return self._registry
     
     @property
-    def occupancy_map(self) -> List[bool]:
-        return self._occupancy_map
+    def occupancy_map(self) -> Dict[Vehicle, Tuple[int, int]]:
+        spot_starts = self._registry.spot_starts
+        return {vehicle: (spot_starts[vehicle_id], spot_starts[vehicle_id] + vehicle.size - 1)
+                for vehicle_id, vehicle in self._parked.items()}
+
+    def __contains__(self, vehicle: Vehicle) -> bool:
+        return self._parked.get(vehicle.vehicle_id) is vehicle
+
+    @property
+    def free_spots(self) -> int:
+        return self._free_runs.free_spots
+
+    @property
+    def largest_free_run(self) -> int:
+        return self._free_runs.largest_free_run
+
+    def is_occupied(self, spot: int) -> bool:
+        return self._free_runs.is_occupied(spot)
     
     def park_vehicle(self, vehicle: Vehicle) -> bool:
-        left, right = 0, vehicle.size
-        while left < self._capacity:
-            if right > self._capacity:
-                return False
-            if self._is_occupied[left]: 
-                left += 1
-                right += 1
-                continue
-            for j in range(left+1, right):
-                if self._is_occupied[j]:
-                    left = j + 1
-                    right = j + 1 + vehicle.size
-                    continue
-            for j in range(left, right):
-                self._is_occupied[j] = True
-            self._occupancy_map[vehicle] = (left, right-1)
-            return True
-        return False
+        if vehicle.registry is not None:
+            return False
+        if self._placement == Placement.BEST_FIT:
+            left = self._free_runs.best_fit(vehicle.size)
+        else:
+            left = self._free_runs.first_fit(vehicle.size)
+        if left is None:
+            return False
+        self.park_vehicle_at(vehicle, left)
+        return True
+
+    def park_vehicle_at(self, vehicle: Vehicle, spot: int) -> None:
+        "parks starting at a given spot, e.g. when restoring state; raises ValueError if it is taken"
+        vehicle_id = self._registry.add(vehicle)
+        try:
+            self._free_runs.occupy(spot, vehicle.size)
+        except ValueError:
+            self._registry.release(vehicle)
+            raise
+        self._registry.spot_starts[vehicle_id] = spot
+        self._parked[vehicle_id] = vehicle
 
     def remove_vehicle(self, vehicle: Vehicle) -> None:
-        if vehicle not in self._occupancy_map:
+        "frees the vehicle's spots and releases its registry row"
+        if vehicle not in self:
             raise ValueError("Vehicle not in the Floor!")
-        left, right = self._occupancy_map[vehicle]
+        left = self._registry.spot_starts[vehicle.vehicle_id]
 
-        for i in range(left, right+1):
-            self._is_occupied[i] = False
-        del self._occupancy_map[vehicle]
+        self._free_runs.release(left, vehicle.size)
+        del self._parked[vehicle.vehicle_id]
+        self._registry.release(vehicle)
 
     @property
     def vehicle_spot(self, vehicle: Vehicle):
-        return self._occupancy_map.get(vehicle, False)
+        return self.occupancy_map.get(vehicle, False)
+
+class FloorPolicy(Enum):
+    LOWEST = 'lowest'
+    LEAST_LOADED = 'least_loaded'  # most free spots
+    NEAREST = 'nearest'            # closest to the entrance floor, lower floor on ties
+
+
+class FloorIndex:
+    """Per-floor free space summary for O(log floors) floor selection.
+
+    A max segment tree over each floor's largest free run tells which floors
+    fit a vehicle of a given size. For least-loaded placement there is one more
+    tree per vehicle size up to max_vehicle_size, holding (free spots, -floor)
+    for floors that fit that size. Larger vehicles fall back to visiting every
+    floor that fits them, O(fitting floors * log floors) per query, so a garage
+    serving bigger vehicles should raise max_vehicle_size. Call update whenever
+    a floor changes.
+    """
+    def __init__(self, floors: List[ParkingFloor], max_vehicle_size: int = 3) -> None:
+        self._floors = floors
+        self._max_vehicle_size = max_vehicle_size
+        size = 1
+        while size < len(floors):
+            size *= 2
+        self._size = size
+        self._largest_run = [0] * (2 * size)
+        self._most_free = [[(-1, 0)] * (2 * size) for _ in range(max_vehicle_size + 1)]
+        for floor_idx in range(len(floors)):
+            self._set_leaf(floor_idx)
+        for node in range(size - 1, 0, -1):
+            self._pull(node)
+
+    def update(self, floor_idx: int) -> None:
+        self._set_leaf(floor_idx)
+        node = (self._size + floor_idx) // 2
+        while node:
+            self._pull(node)
+            node //= 2
+
+    def is_full(self, size: int) -> bool:
+        return self._largest_run[1] < size
+
+    def lowest(self, size: int, start: int = 0) -> Optional[int]:
+        "lowest floor at or above start that fits size"
+        if self.is_full(size):
+            return None
+        return self._first_fitting(1, 0, self._size, start, size)
+
+    def highest(self, size: int, stop: int) -> Optional[int]:
+        "highest floor below stop that fits size"
+        if self.is_full(size):
+            return None
+        return self._last_fitting(1, 0, self._size, stop, size)
+
+    def nearest(self, size: int, entrance: int) -> Optional[int]:
+        above, below = self.lowest(size, entrance), self.highest(size, entrance)
+        if above is None or below is not None and entrance - below <= above - entrance:
+            return below
+        return above
+
+    def least_loaded(self, size: int) -> Optional[int]:
+        if size > self._max_vehicle_size:
+            # no tree for this size, so compare the floors that fit it, lowest first;
+            # linear in the fitting floors rather than logarithmic
+            best_floor = None
+            floor_idx = self.lowest(size)
+            while floor_idx is not None:
+                if best_floor is None or self._floors[floor_idx].free_spots > self._floors[best_floor].free_spots:
+                    best_floor = floor_idx
+                floor_idx = self.lowest(size, floor_idx + 1)
+            return best_floor
+        free_spots, floor = self._most_free[max(size, 1)][1]
+        return -floor if free_spots >= 0 else None
+
+    def _first_fitting(self, node: int, node_start: int, node_end: int, start: int, size: int) -> Optional[int]:
+        if node_end <= start or self._largest_run[node] < size:
+            return None
+        if node >= self._size:
+            return node_start
+        middle = (node_start + node_end) // 2
+        found = self._first_fitting(2 * node, node_start, middle, start, size)
+        if found is None:
+            found = self._first_fitting(2 * node + 1, middle, node_end, start, size)
+        return found
+
+    def _last_fitting(self, node: int, node_start: int, node_end: int, stop: int, size: int) -> Optional[int]:
+        if node_start >= stop or self._largest_run[node] < size:
+            return None
+        if node >= self._size:
+            return node_start
+        middle = (node_start + node_end) // 2
+        found = self._last_fitting(2 * node + 1, middle, node_end, stop, size)
+        if found is None:
+            found = self._last_fitting(2 * node, node_start, middle, stop, size)
+        return found
+
+    def _set_leaf(self, floor_idx: int) -> None:
+        floor = self._floors[floor_idx]
+        node = self._size + floor_idx
+        largest_run = floor.largest_free_run
+        self._largest_run[node] = largest_run
+        entry = (floor.free_spots, -floor_idx)
+        for size in range(1, self._max_vehicle_size + 1):
+            self._most_free[size][node] = entry if largest_run >= size else (-1, 0)
+
+    def _pull(self, node: int) -> None:
+        self._largest_run[node] = max(self._largest_run[2 * node], self._largest_run[2 * node + 1])
+        for size in range(1, self._max_vehicle_size + 1):
+            tree = self._most_free[size]
+            tree[node] = max(tree[2 * node], tree[2 * node + 1])
+
 
 class ParkingGarage:
-    def __init__(self, num_floors: int, capacity_per_floor: int) -> None:
+    def __init__(self, num_floors: int, capacity_per_floor: int, policy: FloorPolicy = FloorPolicy.LOWEST,
+                 entrance_floor: int = 0, placement: Placement = Placement.FIRST_FIT,
+                 max_vehicle_size: int = 3, registry: Optional[VehicleRegistry] = None) -> None:
         self._num_floors = num_floors
-        self._parking_garage = [ParkingFloor(capacity_per_floor) for _ in range(num_floors)]
-        self._vehicle_floor_map = {}
+        self._registry = registry if registry is not None else VehicleRegistry()
+        self._parking_garage = [ParkingFloor(capacity_per_floor, placement, self._registry) for _ in range(num_floors)]
+        self._policy = policy
+        self._entrance_floor = entrance_floor
+        self._floor_index = FloorIndex(self._parking_garage, max_vehicle_size)
+
+    @property
+    def num_floors(self) -> int:
+        return self._num_floors
+
+    @property
+    def floors(self) -> List[ParkingFloor]:
+        return self._parking_garage
+
+    @property
+    def registry(self) -> VehicleRegistry:
+        "rows of the vehicles parked here; shared by all floors"
+        return self._registry
+
+    def find_floor(self, size: int, policy: Optional[FloorPolicy] = None,
+                   entrance_floor: Optional[int] = None) -> Optional[int]:
+        "the floor a vehicle of this size would go to, None if no floor fits it"
+        policy = policy or self._policy
+        if policy == FloorPolicy.LEAST_LOADED:
+            return self._floor_index.least_loaded(size)
+        if policy == FloorPolicy.NEAREST:
+            return self._floor_index.nearest(size, self._entrance_floor if entrance_floor is None else entrance_floor)
+        return self._floor_index.lowest(size)
+
+    def is_full(self, size: int = 1) -> bool:
+        return self._floor_index.is_full(size)
     
-    def park_vehicle(self, vehicle: Vehicle) -> bool:
-        for i in range(len(self._parking_garage)):
-            if self._parking_garage[i].park_vehicle(vehicle):
-                self._vehicle_floor_map[vehicle] = i
-                return True
-        return False
+    def park_vehicle(self, vehicle: Vehicle, entrance_floor: Optional[int] = None) -> bool:
+        floor_idx = self.find_floor(vehicle.size, entrance_floor=entrance_floor)
+        if floor_idx is None or not self._parking_garage[floor_idx].park_vehicle(vehicle):
+            return False
+        self._floor_index.update(floor_idx)
+        self._registry.floors[vehicle.vehicle_id] = floor_idx
+        return True
+
+    def park_vehicle_at(self, vehicle: Vehicle, floor_idx: int, spot: int) -> None:
+        self._parking_garage[floor_idx].park_vehicle_at(vehicle, spot)
+        self._floor_index.update(floor_idx)
+        self._registry.floors[vehicle.vehicle_id] = floor_idx
+
+    def vehicle_floor(self, vehicle: Vehicle) -> Optional[int]:
+        if vehicle.registry is not self._registry:
+            return None
+        floor_idx = vehicle.floor
+        if floor_idx < 0 or floor_idx >= self._num_floors or vehicle not in self._parking_garage[floor_idx]:
+            return None
+        return floor_idx
 
     def remove_vehicle(self, vehicle: Vehicle):
-        if vehicle not in self._vehicle_floor_map:
+        floor_idx = self.vehicle_floor(vehicle)
+        if floor_idx is None:
             raise ValueError("Vehicle not found in the garage!")
-        floor_idx = self._vehicle_floor_map[vehicle]
         self._parking_garage[floor_idx].remove_vehicle(vehicle)
-        del self._vehicle_floor_map[vehicle]
+        self._floor_index.update(floor_idx)
+
+class ConcurrentParkingGarage(ParkingGarage):
+    """ParkingGarage that many gate threads can use at once.
+
+    Each floor has its own lock, so gates parking on different floors never
+    wait on each other. The floor index and vehicle map share a short-held
+    lock. Parking is optimistic: a floor is picked from the index without
+    holding any floor lock, and if another gate filled it in the meantime the
+    index is refreshed for that floor and the pick is retried. Locks are
+    always taken floor first, then index.
+    """
+    def __init__(self, num_floors: int, capacity_per_floor: int, policy: FloorPolicy = FloorPolicy.LOWEST,
+                 entrance_floor: int = 0, placement: Placement = Placement.FIRST_FIT,
+                 max_vehicle_size: int = 3, registry: Optional[VehicleRegistry] = None) -> None:
+        super().__init__(num_floors, capacity_per_floor, policy, entrance_floor, placement, max_vehicle_size, registry)
+        self._floor_locks = [threading.Lock() for _ in range(num_floors)]
+        self._index_lock = threading.Lock()
+        self._retries = 0
+
+    @property
+    def retries(self) -> int:
+        "placements that found their floor filled by another gate and had to pick again"
+        return self._retries
+
+    def find_floor(self, size: int, policy: Optional[FloorPolicy] = None,
+                   entrance_floor: Optional[int] = None) -> Optional[int]:
+        with self._index_lock:
+            return super().find_floor(size, policy, entrance_floor)
+
+    def is_full(self, size: int = 1) -> bool:
+        with self._index_lock:
+            return super().is_full(size)
+
+    def park_vehicle(self, vehicle: Vehicle, entrance_floor: Optional[int] = None) -> bool:
+        while True:
+            floor_idx = self.find_floor(vehicle.size, entrance_floor=entrance_floor)
+            if floor_idx is None:
+                return False
+            with self._floor_locks[floor_idx]:
+                parked = self._parking_garage[floor_idx].park_vehicle(vehicle)
+                with self._index_lock:
+                    self._floor_index.update(floor_idx)
+                    if parked:
+                        self._registry.floors[vehicle.vehicle_id] = floor_idx
+                        return True
+                    self._retries += 1
+
+    def remove_vehicle(self, vehicle: Vehicle):
+        with self._index_lock:
+            floor_idx = self.vehicle_floor(vehicle)
+            if floor_idx is not None:
+                self._registry.floors[vehicle.vehicle_id] = -1
+        if floor_idx is None:
+            raise ValueError("Vehicle not found in the garage!")
+        with self._floor_locks[floor_idx]:
+            self._parking_garage[floor_idx].remove_vehicle(vehicle)
+            with self._index_lock:
+                self._floor_index.update(floor_idx)
+
+
+def wall_clock_hour() -> int:
+    return datetime.datetime.now().hour
+
 
 class ParkingPaymentSystem:
-    def __init__(self, parking_garage: ParkingGarage, hourly_rate: int):
+    def __init__(self, parking_garage: ParkingGarage, hourly_rate: int,
+                 clock: Callable[[], int] = wall_clock_hour):
         self._parking_garage = parking_garage
         self._hourly_rate = hourly_rate
+        self._clock = clock  # returns the current hour; replays pass event time instead
         self._time_parked = {} # map driver_id to time that they parked
 
     def park_vehicle(self, driver: Driver) -> bool:
-        current_hour = datetime.datetime.now().hour
+        current_hour = self._clock()
         if self._parking_garage.park_vehicle(driver.vehicle):
             self._time_parked[driver.driver_id] = current_hour
+            self._parking_garage.registry.park_times[driver.vehicle.vehicle_id] = current_hour
             return True
         
         else:
             return False
 
     def remove_vehicle(self, driver: Driver) -> bool:
-        if driver.driver_id not in self._time_parked:
+        price = self.check_out(driver)
+        if price is None:
             return False
+        driver.charge(price)
+        return True
+
+    def check_out(self, driver: Driver) -> Optional[float]:
+        "removes the vehicle and returns its price without charging the driver, None if it could not leave"
+        if driver.driver_id not in self._time_parked:
+            return None
         try:
             self._parking_garage.remove_vehicle(driver.vehicle)
-            current_hour = datetime.datetime.now().hour
+            current_hour = self._clock()
             price = self._hourly_rate * driver.vehicle.size * (current_hour - self._time_parked[driver.driver_id] + 1)
-            driver.charge(price)
             
             del self._time_parked[driver.driver_id]
-            return True
+            return price
         except ValueError as e:
             print("Error: {}".format(e))
-            return False
+            return None
+
+class ConcurrentParkingPaymentSystem(ParkingPaymentSystem):
+    "guards the parked-time book so a driver can only be checked in or out by one gate at a time"
+    def __init__(self, parking_garage: ConcurrentParkingGarage, hourly_rate: int,
+                 clock: Callable[[], int] = wall_clock_hour):
+        super().__init__(parking_garage, hourly_rate, clock)
+        self._lock = threading.Lock()
+
+    def park_vehicle(self, driver: Driver, entrance_floor: Optional[int] = None) -> bool:
+        with self._lock:
+            if driver.driver_id in self._time_parked:
+                return False
+            self._time_parked[driver.driver_id] = None  # claimed while the garage parks the vehicle
+        current_hour = self._clock()
+        parked = self._parking_garage.park_vehicle(driver.vehicle, entrance_floor)
+        with self._lock:
+            if parked:
+                self._time_parked[driver.driver_id] = current_hour
+                self._parking_garage.registry.park_times[driver.vehicle.vehicle_id] = current_hour
+            else:
+                del self._time_parked[driver.driver_id]
+        return parked
+
+    def check_out(self, driver: Driver) -> Optional[float]:
+        with self._lock:
+            parked_hour = self._time_parked.get(driver.driver_id)
+            if parked_hour is None:
+                return None
+            del self._time_parked[driver.driver_id]
+        try:
+            self._parking_garage.remove_vehicle(driver.vehicle)
+        except ValueError as e:
+            with self._lock:
+                self._time_parked[driver.driver_id] = parked_hour
+            print("Error: {}".format(e))
+            return None
+        return self._hourly_rate * driver.vehicle.size * (self._clock() - parked_hour + 1)
+
+
+def check_no_double_occupancy(parking_garage: ParkingGarage) -> None:
+    "raises ValueError if two vehicles share a spot or the floor indexes disagree with the vehicles"
+    for floor_idx, floor in enumerate(parking_garage.floors):
+        taken = [False] * floor.capacity
+        for vehicle, (left, right) in floor.occupancy_map.items():
+            if vehicle.floor != floor_idx:
+                raise ValueError('Vehicle on floor {} is not mapped to it'.format(floor_idx))
+            for spot in range(left, right + 1):
+                if taken[spot]:
+                    raise ValueError('Spot {} on floor {} is double occupied'.format(spot, floor_idx))
+                taken[spot] = True
+        if any(taken[spot] != floor.is_occupied(spot) for spot in range(floor.capacity)):
+            raise ValueError('Free spot index of floor {} is out of sync'.format(floor_idx))
+
+
+def stress_test(n_gates: int = 8, operations_per_gate: int = 20000, num_floors: int = 8,
+                capacity_per_floor: int = 500, policy: FloorPolicy = FloorPolicy.NEAREST, seed: int = 0) -> float:
+    """runs gate threads that park and remove random vehicles, each gate entering at
+    its own floor; checks the garage afterwards and returns operations per second"""
+    parking_garage = ConcurrentParkingGarage(num_floors, capacity_per_floor, policy)
+    payment_system = ConcurrentParkingPaymentSystem(parking_garage, 5)
+    vehicle_types = (Car, Limo, Truck)
+
+    def gate(gate_idx: int) -> None:
+        rng = random.Random('{}:{}'.format(seed, gate_idx))
+        entrance_floor = gate_idx % num_floors
+        parked = []
+        for operation in range(operations_per_gate):
+            if parked and rng.random() < 0.45:
+                driver = parked.pop(rng.randrange(len(parked)))
+                if not payment_system.remove_vehicle(driver):
+                    raise ValueError('Parked driver {} could not leave'.format(driver.driver_id))
+            else:
+                driver = Driver(rng.choice(vehicle_types)(), gate_idx * operations_per_gate + operation)
+                if payment_system.park_vehicle(driver, entrance_floor):
+                    parked.append(driver)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=n_gates) as executor:
+        for future in [executor.submit(gate, gate_idx) for gate_idx in range(n_gates)]:
+            future.result()
+    elapsed = time.perf_counter() - start
+    check_no_double_occupancy(parking_garage)
+    return n_gates * operations_per_gate / elapsed
+
+
+# Gate logs. An event is (timestamp in seconds, kind, driver id, vehicle size).
+# Binary logs hold fixed-size EVENT_FORMAT records; CSV logs hold
+# timestamp,kind,driver_id,size rows with kind spelled enter or exit.
+ENTER, EXIT = 0, 1
+EVENT_FORMAT = struct.Struct('<qBIB')
+VEHICLE_TYPES = {1: Car, 2: Limo, 3: Truck}
+Event = Tuple[int, int, int, int]
+
+
+def read_csv_events(path: str) -> Iterator[Event]:
+    kinds = {'enter': ENTER, 'exit': EXIT}
+    with open(path, newline='') as f:
+        for row in csv.reader(f):
+            if not row or row[0] == 'timestamp':
+                continue
+            yield int(row[0]), kinds[row[1]], int(row[2]), int(row[3])
+
+
+def write_csv_events(path: str, events: Iterable[Event]) -> None:
+    names = ('enter', 'exit')
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(('timestamp', 'kind', 'driver_id', 'size'))
+        writer.writerows((timestamp, names[kind], driver_id, size) for timestamp, kind, driver_id, size in events)
+
+
+def read_binary_events(path: str, chunk_records: int = 65536) -> Iterator[Event]:
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(EVENT_FORMAT.size * chunk_records)
+            if not chunk:
+                return
+            if len(chunk) % EVENT_FORMAT.size:
+                raise ValueError('Truncated event log {}'.format(path))
+            yield from EVENT_FORMAT.iter_unpack(chunk)
+
+
+def write_binary_events(path: str, events: Iterable[Event]) -> None:
+    pack = EVENT_FORMAT.pack
+    with open(path, 'wb') as f:
+        f.writelines(pack(*event) for event in events)
+
+
+def generate_events(n_drivers: int, seed: int = 0, start: int = 0, mean_stay: int = 3 * 3600,
+                    day_seconds: int = 24 * 3600) -> List[Event]:
+    "a synthetic day: drivers arrive uniformly through it, stay an exponential time and leave"
+    rng = random.Random(seed)
+    events = []
+    for driver_id in range(n_drivers):
+        arrival = start + rng.randrange(day_seconds)
+        size = rng.choice((1, 1, 1, 2, 3))
+        events.append((arrival, ENTER, driver_id, size))
+        events.append((arrival + 1 + int(rng.expovariate(1 / mean_stay)), EXIT, driver_id, size))
+    events.sort()
+    return events
+
+
+class ReplayReport:
+    def __init__(self, events: int, rejections: Dict[int, int], unmatched_exits: int, duplicate_entries: int,
+                 charges: Dict[int, float], occupancy: array, start: int, bucket_seconds: int, elapsed: float) -> None:
+        self._events = events
+        self._rejections = rejections
+        self._unmatched_exits = unmatched_exits
+        self._duplicate_entries = duplicate_entries
+        self._charges = charges
+        self._occupancy = occupancy
+        self._start = start
+        self._bucket_seconds = bucket_seconds
+        self._elapsed = elapsed
+
+    @property
+    def events(self) -> int:
+        return self._events
+
+    @property
+    def rejections(self) -> Dict[int, int]:
+        "rejected entries by vehicle size"
+        return self._rejections
+
+    @property
+    def unmatched_exits(self) -> int:
+        "exits of drivers that were not parked, e.g. because their entry was rejected"
+        return self._unmatched_exits
+
+    @property
+    def duplicate_entries(self) -> int:
+        "entries of drivers already parked, e.g. after a missed exit scan; the first entry stands"
+        return self._duplicate_entries
+
+    @property
+    def charges(self) -> Dict[int, float]:
+        "total charged per driver id"
+        return self._charges
+
+    @property
+    def revenue(self) -> float:
+        return sum(self._charges.values())
+
+    @property
+    def occupancy(self) -> array:
+        "spots in use at the end of each bucket"
+        return self._occupancy
+
+    def occupancy_series(self) -> List[Tuple[int, int]]:
+        "(bucket start timestamp, spots in use) pairs"
+        return [(self._start + i * self._bucket_seconds, spots) for i, spots in enumerate(self._occupancy)]
+
+    @property
+    def events_per_second(self) -> float:
+        return self._events / self._elapsed if self._elapsed > 0 else 0.0
+
+    def __repr__(self) -> str:
+        return 'ReplayReport(events={}, rejections={}, unmatched_exits={}, duplicate_entries={}, revenue={}, events/sec={:.0f})'.format(
+            self._events, sum(self._rejections.values()), self._unmatched_exits, self._duplicate_entries, self.revenue,
+            self.events_per_second)
+
+
+class EventReplayer:
+    """Streams timestamped gate events through a garage and payment system.
+
+    The payment system reads the hour from the event being replayed instead of
+    the wall clock. Hours are counted from the epoch, so stays across midnight
+    are billed correctly. Prices are collected per exit and added up per
+    driver once the stream ends.
+    """
+    def __init__(self, parking_garage: ParkingGarage, hourly_rate: int, bucket_seconds: int = 3600) -> None:
+        self._parking_garage = parking_garage
+        self._payment_system = ParkingPaymentSystem(parking_garage, hourly_rate, clock=self._event_hour)
+        self._bucket_seconds = bucket_seconds
+        self._hour = 0
+
+    def _event_hour(self) -> int:
+        return self._hour
+
+    def replay(self, events: Iterable[Event]) -> ReplayReport:
+        started = time.perf_counter()
+        payment_system = self._payment_system
+        bucket_seconds = self._bucket_seconds
+        drivers = {}
+        rejections = {size: 0 for size in VEHICLE_TYPES}
+        unmatched_exits = duplicate_entries = 0
+        billed_ids, billed_prices = array('q'), array('d')
+        occupancy = array('q')
+        spots_in_use = 0
+        start = bucket_end = None
+        last_timestamp = None
+        n_events = 0
+        for timestamp, kind, driver_id, size in events:
+            if start is None:
+                start = timestamp - timestamp % bucket_seconds
+                bucket_end = start + bucket_seconds
+                last_timestamp = timestamp
+            if timestamp < last_timestamp:
+                raise ValueError('Events must be in time order')
+            last_timestamp = timestamp
+            while timestamp >= bucket_end:
+                occupancy.append(spots_in_use)
+                bucket_end += bucket_seconds
+            self._hour = timestamp // 3600
+            n_events += 1
+            if kind == ENTER:
+                if driver_id in drivers:
+                    duplicate_entries += 1
+                    continue
+                driver = Driver(VEHICLE_TYPES[size](), driver_id)
+                if payment_system.park_vehicle(driver):
+                    drivers[driver_id] = driver
+                    spots_in_use += size
+                else:
+                    rejections[size] += 1
+            else:
+                driver = drivers.pop(driver_id, None)
+                if driver is None:
+                    unmatched_exits += 1
+                    continue
+                billed_ids.append(driver_id)
+                billed_prices.append(payment_system.check_out(driver))
+                spots_in_use -= driver.vehicle.size
+        if start is not None:
+            occupancy.append(spots_in_use)
+
+        charges = dict.fromkeys(billed_ids, 0.0)
+        for driver_id, price in zip(billed_ids, billed_prices):
+            charges[driver_id] += price
+        return ReplayReport(n_events, rejections, unmatched_exits, duplicate_entries, charges, occupancy,
+                            start or 0, bucket_seconds, time.perf_counter() - started)
+
+
+# Persistence. A snapshot holds the garage shape, one occupancy bitmap per
+# floor and a table of parked vehicles. Every park and remove after it is
+# appended to a log named after the snapshot generation it follows, so a
+# restart loads the snapshot and replays only the logs from that generation on.
+SNAPSHOT_FILE = 'snapshot.bin'
+SNAPSHOT_HEADER = struct.Struct('<4sIIIQ')  # magic, floors, capacity per floor, vehicles, generation
+SNAPSHOT_VEHICLE = struct.Struct('<IBiiq')  # driver id, size, floor, first spot, hour parked
+LOG_RECORD = struct.Struct('<BIBiiq')       # ENTER or EXIT, then the same fields as SNAPSHOT_VEHICLE
+
+
+def _log_path(directory: str, generation: int) -> str:
+    return os.path.join(directory, 'log.{:08d}'.format(generation))
+
+
+def _log_generations(directory: str) -> List[int]:
+    return sorted(int(name[4:]) for name in os.listdir(directory) if name.startswith('log.') and name[4:].isdigit())
+
+
+class PersistentParkingPaymentSystem(ParkingPaymentSystem):
+    """ParkingPaymentSystem that survives restarts.
+
+    Each successful park or check-out is appended to the current log. Once
+    compact_after records have been logged, a compaction starts a new log
+    generation and writes a fresh snapshot from a background thread; older
+    logs are deleted once that snapshot is in place. Use restore to reload.
+    """
+    def __init__(self, parking_garage: ParkingGarage, hourly_rate: int, directory: str,
+                 clock: Callable[[], int] = wall_clock_hour, compact_after: int = 100000,
+                 sync: bool = False, _generation: Optional[int] = None):
+        super().__init__(parking_garage, hourly_rate, clock)
+        self._directory = directory
+        self._compact_after = compact_after
+        self._sync = sync
+        self._lock = threading.Lock()
+        self._drivers = {}  # driver id -> Driver, for the parked ones
+        self._compacting = False
+        self._compaction = None
+        os.makedirs(directory, exist_ok=True)
+        if _generation is None:
+            if os.path.exists(os.path.join(directory, SNAPSHOT_FILE)):
+                raise ValueError('{} already holds a parking snapshot, use restore'.format(directory))
+            _generation = 0
+            self._write_snapshot(self._capture(), _generation)
+        self._generation = _generation
+        self._log = open(_log_path(directory, _generation), 'ab')
+        self._logged = 0
+
+    @property
+    def parked_drivers(self) -> Dict[int, Driver]:
+        return self._drivers
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def park_vehicle(self, driver: Driver) -> bool:
+        with self._lock:
+            if driver.driver_id in self._drivers or not super().park_vehicle(driver):
+                return False
+            self._drivers[driver.driver_id] = driver
+            self._append(ENTER, driver)
+        return True
+
+    def check_out(self, driver: Driver) -> Optional[float]:
+        with self._lock:
+            price = super().check_out(driver)
+            if price is not None:
+                del self._drivers[driver.driver_id]
+                self._append(EXIT, driver)
+        return price
+
+    def compact(self, background: bool = True) -> Optional[threading.Thread]:
+        """starts a new log generation and snapshots into it, returning the writer thread
+        when run in the background; does nothing if a compaction is already running"""
+        with self._lock:
+            if self._compacting:
+                return None
+            self._compacting = True
+            self._log.close()
+            self._generation += 1
+            self._log = open(_log_path(self._directory, self._generation), 'ab')
+            self._logged = 0
+            rows = self._capture()
+        if not background:
+            self._finish_compaction(rows, self._generation)
+            return None
+        self._compaction = threading.Thread(target=self._finish_compaction, args=(rows, self._generation))
+        self._compaction.start()
+        return self._compaction
+
+    def _finish_compaction(self, rows: List[Tuple[int, int, int, int, int]], generation: int) -> None:
+        try:
+            self._write_snapshot(rows, generation)
+        finally:
+            self._compacting = False
+
+    def close(self) -> None:
+        if self._compaction is not None:
+            self._compaction.join()
+        self._log.close()
+
+    def _append(self, kind: int, driver: Driver) -> None:
+        vehicle = driver.vehicle
+        self._log.write(LOG_RECORD.pack(kind, driver.driver_id, vehicle.size, vehicle.floor,
+                                        vehicle.spot_start, self._time_parked.get(driver.driver_id, -1)))
+        self._log.flush()
+        if self._sync:
+            os.fsync(self._log.fileno())
+        self._logged += 1
+        if self._logged >= self._compact_after and not self._compacting:
+            self._logged = 0
+            self._compaction = threading.Thread(target=self.compact, kwargs={'background': False})
+            self._compaction.start()
+
+    def _capture(self) -> List[Tuple[int, int, int, int, int]]:
+        return [(driver_id, driver.vehicle.size, driver.vehicle.floor, driver.vehicle.spot_start,
+                 self._time_parked[driver_id]) for driver_id, driver in self._drivers.items()]
+
+    def _write_snapshot(self, rows: List[Tuple[int, int, int, int, int]], generation: int) -> None:
+        num_floors = self._parking_garage.num_floors
+        capacity = self._parking_garage.floors[0].capacity if num_floors else 0
+        bitmap_bytes = (capacity + 7) // 8
+        bitmaps = bytearray(num_floors * bitmap_bytes)
+        for _, size, floor_idx, spot, _ in rows:
+            for taken in range(spot, spot + size):
+                bitmaps[floor_idx * bitmap_bytes + taken // 8] |= 1 << (taken % 8)
+        path = os.path.join(self._directory, SNAPSHOT_FILE)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(SNAPSHOT_HEADER.pack(b'PKSN', num_floors, capacity, len(rows), generation))
+            f.write(bitmaps)
+            f.writelines(SNAPSHOT_VEHICLE.pack(*row) for row in rows)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        for old_generation in _log_generations(self._directory):
+            if old_generation < generation:
+                os.remove(_log_path(self._directory, old_generation))
+
+    @classmethod
+    def restore(cls, directory: str, hourly_rate: int, clock: Callable[[], int] = wall_clock_hour,
+                compact_after: int = 100000, sync: bool = False,
+                policy: FloorPolicy = FloorPolicy.LOWEST) -> 'PersistentParkingPaymentSystem':
+        """rebuilds the garage from the mmapped snapshot, replays the log tail and
+        drops a partly written last record, if any"""
+        with open(os.path.join(directory, SNAPSHOT_FILE), 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as snapshot:
+            magic, num_floors, capacity, n_vehicles, generation = SNAPSHOT_HEADER.unpack_from(snapshot)
+            if magic != b'PKSN':
+                raise ValueError('{} is not a parking snapshot'.format(directory))
+            parking_garage = ParkingGarage(num_floors, capacity, policy)
+            system = cls(parking_garage, hourly_rate, directory, clock, compact_after, sync, _generation=generation)
+            bitmap_bytes = (capacity + 7) // 8
+            bitmaps_start = SNAPSHOT_HEADER.size
+            vehicles_start = bitmaps_start + num_floors * bitmap_bytes
+            vehicles = memoryview(snapshot)[vehicles_start:vehicles_start + n_vehicles * SNAPSHOT_VEHICLE.size]
+            for driver_id, size, floor_idx, spot, hour in SNAPSHOT_VEHICLE.iter_unpack(vehicles):
+                system._restore_park(driver_id, size, floor_idx, spot, hour)
+            vehicles.release()
+            for floor_idx, floor in enumerate(parking_garage.floors):
+                offset = bitmaps_start + floor_idx * bitmap_bytes
+                for spot in range(capacity):
+                    if bool(snapshot[offset + spot // 8] >> (spot % 8) & 1) != floor.is_occupied(spot):
+                        raise ValueError('Snapshot bitmap of floor {} does not match its vehicles'.format(floor_idx))
+
+        for log_generation in _log_generations(directory):
+            if log_generation < generation:
+                continue
+            path = _log_path(directory, log_generation)
+            with open(path, 'rb') as f:
+                data = f.read()
+            complete = len(data) - len(data) % LOG_RECORD.size
+            for kind, driver_id, size, floor_idx, spot, hour in LOG_RECORD.iter_unpack(data[:complete]):
+                if kind == ENTER:
+                    system._restore_park(driver_id, size, floor_idx, spot, hour)
+                else:
+                    driver = system._drivers.pop(driver_id)
+                    parking_garage.remove_vehicle(driver.vehicle)
+                    del system._time_parked[driver_id]
+            if complete != len(data):
+                os.truncate(path, complete)
+            if log_generation > system._generation:
+                system._log.close()
+                system._generation = log_generation
+                system._log = open(path, 'ab')
+        return system
+
+    def _restore_park(self, driver_id: int, size: int, floor_idx: int, spot: int, hour: int) -> None:
+        driver = Driver(VEHICLE_TYPES[size](), driver_id)
+        self._parking_garage.park_vehicle_at(driver.vehicle, floor_idx, spot)
+        self._time_parked[driver_id] = hour
+        self._parking_garage.registry.park_times[driver.vehicle.vehicle_id] = hour
+        self._drivers[driver_id] = driver
+
+
+def memory_benchmark(n_vehicles: int = 200000, num_floors: int = 10) -> Dict[str, float]:
+    """bytes per parked vehicle, as traced by tracemalloc, for a garage full of cars
+    against the previous layout of __dict__ vehicles keyed into two dicts"""
+    class DictVehicle:
+        def __init__(self, size: int) -> None:
+            self._size = size
+
+    capacity_per_floor = -(-n_vehicles // num_floors)
+    tracemalloc.start()
+    try:
+        baseline = tracemalloc.get_traced_memory()[0]
+        vehicles = [DictVehicle(1) for _ in range(n_vehicles)]
+        occupancy_map = {vehicle: (i % capacity_per_floor, i % capacity_per_floor) for i, vehicle in enumerate(vehicles)}
+        vehicle_floor_map = {vehicle: i // capacity_per_floor for i, vehicle in enumerate(vehicles)}
+        dict_bytes = tracemalloc.get_traced_memory()[0] - baseline
+        del vehicles, occupancy_map, vehicle_floor_map
+
+        parking_garage = ParkingGarage(num_floors, capacity_per_floor)
+        baseline = tracemalloc.get_traced_memory()[0]
+        for _ in range(n_vehicles):
+            parking_garage.park_vehicle(Car())
+        registry_bytes = tracemalloc.get_traced_memory()[0] - baseline
+    finally:
+        tracemalloc.stop()
+    return {'dict_vehicle_bytes': dict_bytes / n_vehicles, 'registry_vehicle_bytes': registry_bytes / n_vehicles}
+
+
+def benchmark_gates(gate_counts: List[int] = (1, 2, 4, 8), operations_per_gate: int = 20000) -> None:
+    for n_gates in gate_counts:
+        print('{} gates: {:.0f} operations/sec'.format(n_gates, stress_test(n_gates, operations_per_gate)))
+
 
 if __name__ == '__main__':
     parking_garage = ParkingGarage(3, 2)
@@ -1,11 +1,24 @@
-from typing import List, Set
+from typing import Dict, Iterator, List, Optional, Sequence, Set, Tuple, Union
+from array import array
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, nullcontext
+import math
+import mmap
+import os
 import random
+import struct
+import threading
+import time
 from abc import ABC, abstractmethod
 
 class BankAccount:
-    def __init__(self, customer_id: int, init_deposit: float) -> None:
+    "a view over one row of a balance column; an account made on its own gets a column of its own"
+    def __init__(self, customer_id: int, init_deposit: float, balances: Optional[array] = None) -> None:
         self._id = customer_id
-        self._balance = init_deposit
+        self._balances = array('d') if balances is None else balances
+        self._row = len(self._balances)
+        self._balances.append(init_deposit)
 
     @property
     def customer_id(self) -> int:
@@ -13,14 +26,20 @@ class BankAccount:
     
     @property
     def balance(self) -> float:
-        return self._balance
+        return self._balances[self._row]
+
+    def attach(self, balances: array) -> None:
+        "moves the balance into a new last row of balances"
+        row = len(balances)
+        balances.append(self.balance)
+        self._balances, self._row = balances, row
 
     def deposit(self, amount: float) -> None:
-        self._balance += amount
+        self._balances[self._row] += amount
     
     def withdraw(self, amount: float) -> bool:
-        if amount <= self._balance:
-            self._balance -= amount
+        if amount <= self._balances[self._row]:
+            self._balances[self._row] -= amount
             return True
         return False
 
@@ -54,6 +73,10 @@ class Withdrawal(Transaction):
     def __init__(self, customer_id: int, teller_id: int, amount: float):
         self._amount = amount
         super().__init__(customer_id, teller_id)
+
+    @property
+    def amount(self) -> float:
+        return self._amount
     
     def get_transaction_description(self):
         return 'teller {} withdrew {}$ from account {}'.format(self.teller_id, self._amount, self.customer_id)
@@ -62,6 +85,10 @@ class Deposit(Transaction):
     def __init__(self, customer_id: int, teller_id: int, amount: float):
         self._amount = amount
         super().__init__(customer_id, teller_id)
+
+    @property
+    def amount(self) -> float:
+        return self._amount
     
     def get_transaction_description(self):
         return 'teller {} deposited {}$ from account {}'.format(self.teller_id, self._amount, self.customer_id)
@@ -70,46 +97,637 @@ class OpenAccount(Transaction):
     def __init__(self, customer_id: int, teller_id: int, init_deposit: float = 0):
         super().__init__(customer_id, teller_id)
         self._init_deposit = init_deposit
+
+    @property
+    def amount(self) -> float:
+        return self._init_deposit
     
     def get_transaction_description(self):
         return 'teller {} opened account {} with initial deposit {}'.format(self.teller_id, self.customer_id, self._init_deposit)
 
 
+# Journal record kinds, in the order of TRANSACTION_TYPES
+OPEN_ACCOUNT, DEPOSIT, WITHDRAWAL = 0, 1, 2
+TRANSACTION_TYPES = (OpenAccount, Deposit, Withdrawal)
+JOURNAL_RECORD = struct.Struct('<Bqqdd')  # kind, customer id, teller id, amount, timestamp
+SEGMENT_HEADER = struct.Struct('<4sQ')    # magic, records written
+
+
+class JournalSegment:
+    "a preallocated, memory-mapped file of up to capacity journal records"
+    def __init__(self, path: str, capacity: int) -> None:
+        self._path = path
+        if not os.path.exists(path):
+            with open(path, 'wb') as f:
+                f.write(SEGMENT_HEADER.pack(b'BKJ1', 0))
+                f.truncate(SEGMENT_HEADER.size + capacity * JOURNAL_RECORD.size)
+        self._file = open(path, 'r+b')
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        magic, self._count = SEGMENT_HEADER.unpack_from(self._map)
+        if magic != b'BKJ1':
+            raise ValueError('{} is not a journal segment'.format(path))
+        self._capacity = (len(self._map) - SEGMENT_HEADER.size) // JOURNAL_RECORD.size
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    @property
+    def count(self) -> int:
+        return self._count
+
+    @property
+    def capacity(self) -> int:
+        return self._capacity
+
+    @property
+    def is_full(self) -> bool:
+        return self._count >= self._capacity
+
+    def append(self, kind: int, customer_id: int, teller_id: int, amount: float, timestamp: float) -> None:
+        JOURNAL_RECORD.pack_into(self._map, SEGMENT_HEADER.size + self._count * JOURNAL_RECORD.size,
+                                 kind, customer_id, teller_id, amount, timestamp)
+        self._count += 1
+        SEGMENT_HEADER.pack_into(self._map, 0, b'BKJ1', self._count)
+
+    def append_many(self, kinds: Sequence[int], customer_ids: Sequence[int], teller_ids: Sequence[int],
+                    amounts: Sequence[float], timestamp: float) -> None:
+        "packs each record in place with the shared record layout, then updates the header once"
+        pack_into, record_size = JOURNAL_RECORD.pack_into, JOURNAL_RECORD.size
+        offset = SEGMENT_HEADER.size + self._count * record_size
+        for kind, customer_id, teller_id, amount in zip(kinds, customer_ids, teller_ids, amounts):
+            pack_into(self._map, offset, kind, customer_id, teller_id, amount, timestamp)
+            offset += record_size
+        self._count += len(kinds)
+        SEGMENT_HEADER.pack_into(self._map, 0, b'BKJ1', self._count)
+
+    def read(self, index: int) -> Tuple[int, int, int, float, float]:
+        return JOURNAL_RECORD.unpack_from(self._map, SEGMENT_HEADER.size + index * JOURNAL_RECORD.size)
+
+    def records(self) -> Iterator[Tuple[int, int, int, float, float]]:
+        end = SEGMENT_HEADER.size + self._count * JOURNAL_RECORD.size
+        return JOURNAL_RECORD.iter_unpack(self._map[SEGMENT_HEADER.size:end])
+
+    def flush(self) -> None:
+        self._map.flush()
+
+    def close(self) -> None:
+        self._map.close()
+        self._file.close()
+
+
+class TransactionJournal:
+    """Append-only transaction log over fixed-width records in segment files.
+
+    Every record gets a position, counted from the first record ever written.
+    Positions are indexed per account and per teller, so one account's history
+    costs O(its transactions). Records are only turned into Transaction objects
+    when read. When a segment fills up, or on rotate, writing moves on to a
+    new segment; archive_segments drops the oldest ones from the journal.
+    Reopening a directory rebuilds the indexes from the segments on disk.
+    """
+    def __init__(self, directory: str, records_per_segment: int = 1 << 16) -> None:
+        self._directory = directory
+        self._records_per_segment = records_per_segment
+        self._segments = []
+        self._segment_starts = []  # position of the first record of each segment
+        self._account_index = {}
+        self._teller_index = {}
+        os.makedirs(directory, exist_ok=True)
+        names = sorted(name for name in os.listdir(directory) if name.startswith('segment.'))
+        position = int(names[0][8:]) if names else 0
+        for name in names:
+            segment = JournalSegment(os.path.join(directory, name), records_per_segment)
+            self._segments.append(segment)
+            self._segment_starts.append(position)
+            for kind, customer_id, teller_id, _, _ in segment.records():
+                self._index(position, customer_id, teller_id)
+                position += 1
+        self._size = position
+        if not self._segments:
+            self._open_segment()
+
+    @property
+    def first_position(self) -> int:
+        return self._segment_starts[0]
+
+    def __len__(self) -> int:
+        "records still in the journal, i.e. not archived"
+        return self._size - self._segment_starts[0]
+
+    @property
+    def end_position(self) -> int:
+        return self._size
+
+    def append(self, kind: int, customer_id: int, teller_id: int, amount: float,
+               timestamp: Optional[float] = None) -> int:
+        if self._segments[-1].is_full:
+            self._open_segment()
+        self._segments[-1].append(kind, customer_id, teller_id, amount,
+                                  time.time() if timestamp is None else timestamp)
+        position = self._size
+        self._index(position, customer_id, teller_id)
+        self._size += 1
+        return position
+
+    def append_many(self, kinds: Sequence[int], customer_ids: Sequence[int], teller_ids: Sequence[int],
+                    amounts: Sequence[float], timestamp: Optional[float] = None) -> int:
+        "appends records sharing one timestamp, filling segments a chunk at a time; returns the first position"
+        timestamp = time.time() if timestamp is None else timestamp
+        first_position = self._size
+        done = 0
+        while done < len(kinds):
+            if self._segments[-1].is_full:
+                self._open_segment()
+            segment = self._segments[-1]
+            end = min(len(kinds), done + segment.capacity - segment.count)
+            segment.append_many(kinds[done:end], customer_ids[done:end], teller_ids[done:end], amounts[done:end],
+                                timestamp)
+            chunk_positions = range(self._size, self._size + end - done)
+            self._index_many(self._account_index, chunk_positions, customer_ids[done:end])
+            self._index_many(self._teller_index, chunk_positions, teller_ids[done:end])
+            self._size += end - done
+            done = end
+        return first_position
+
+    def record(self, position: int) -> Tuple[int, int, int, float, float]:
+        "(kind, customer id, teller id, amount, timestamp) at a position"
+        if not self._segment_starts[0] <= position < self._size:
+            raise IndexError('Journal position {} out of range'.format(position))
+        segment_idx = bisect_left(self._segment_starts, position + 1) - 1
+        return self._segments[segment_idx].read(position - self._segment_starts[segment_idx])
+
+    def transaction(self, position: int) -> Transaction:
+        kind, customer_id, teller_id, amount, _ = self.record(position)
+        return TRANSACTION_TYPES[kind](customer_id, teller_id, amount)
+
+    def transactions(self) -> 'JournalTransactions':
+        return JournalTransactions(self)
+
+    def account_positions(self, customer_id: int) -> array:
+        return self._account_index.get(customer_id, array('q'))
+
+    def teller_positions(self, teller_id: int) -> array:
+        return self._teller_index.get(teller_id, array('q'))
+
+    def account_history(self, customer_id: int) -> List[Transaction]:
+        return [self.transaction(position) for position in self.account_positions(customer_id)]
+
+    def teller_history(self, teller_id: int) -> List[Transaction]:
+        return [self.transaction(position) for position in self.teller_positions(teller_id)]
+
+    def rotate(self) -> None:
+        "seals the current segment; the next append starts a new one"
+        if self._segments[-1].count:
+            self._open_segment()
+
+    def archive_segments(self, keep: int) -> List[str]:
+        """closes all but the newest keep segments and drops their records from the
+        indexes; returns their paths so they can be moved off or deleted"""
+        archived = []
+        while len(self._segments) > max(keep, 1):
+            segment = self._segments.pop(0)
+            self._segment_starts.pop(0)
+            segment.close()
+            archived.append(segment.path)
+        if archived:
+            first_position = self._segment_starts[0]
+            for index in (self._account_index, self._teller_index):
+                for key, positions in list(index.items()):
+                    del positions[:bisect_left(positions, first_position)]
+                    if not positions:
+                        del index[key]
+        return archived
+
+    def flush(self) -> None:
+        for segment in self._segments:
+            segment.flush()
+
+    def close(self) -> None:
+        for segment in self._segments:
+            segment.close()
+
+    def _index(self, position: int, customer_id: int, teller_id: int) -> None:
+        positions = self._account_index.get(customer_id)
+        if positions is None:
+            positions = self._account_index[customer_id] = array('q')
+        positions.append(position)
+        positions = self._teller_index.get(teller_id)
+        if positions is None:
+            positions = self._teller_index[teller_id] = array('q')
+        positions.append(position)
+
+    @staticmethod
+    def _index_many(index: Dict[int, array], positions: range, keys: Sequence[int]) -> None:
+        if len(keys) and keys.count(keys[0]) == len(keys):  # e.g. one teller for a whole batch
+            index.setdefault(keys[0], array('q')).extend(positions)
+            return
+        for position, key in zip(positions, keys):
+            try:
+                index[key].append(position)
+            except KeyError:
+                index[key] = array('q', [position])
+
+    def _open_segment(self) -> None:
+        path = os.path.join(self._directory, 'segment.{:012d}'.format(self._size))
+        self._segments.append(JournalSegment(path, self._records_per_segment))
+        self._segment_starts.append(self._size)
+
+
+class JournalTransactions:
+    "read-only list view of a journal that materializes Transaction objects on access"
+    def __init__(self, journal: TransactionJournal) -> None:
+        self._journal = journal
+
+    def __len__(self) -> int:
+        return len(self._journal)
+
+    def __getitem__(self, i: int) -> Transaction:
+        if i < 0:
+            i += len(self._journal)
+        if not 0 <= i < len(self._journal):
+            raise IndexError('Transaction index out of range')
+        return self._journal.transaction(self._journal.first_position + i)
+
+    def __iter__(self) -> Iterator[Transaction]:
+        for position in range(self._journal.first_position, self._journal.end_position):
+            yield self._journal.transaction(position)
+
+
+class RunningTotals:
+    "deposit and withdrawal sums and counts, kept up to date as postings happen"
+    def __init__(self) -> None:
+        self._deposits = 0.0
+        self._withdrawals = 0.0
+        self._deposit_count = 0
+        self._withdrawal_count = 0
+        self._accounts_opened = 0
+
+    @property
+    def deposits(self) -> float:
+        "includes initial deposits of opened accounts"
+        return self._deposits
+
+    @property
+    def withdrawals(self) -> float:
+        return self._withdrawals
+
+    @property
+    def deposit_count(self) -> int:
+        return self._deposit_count
+
+    @property
+    def withdrawal_count(self) -> int:
+        return self._withdrawal_count
+
+    @property
+    def accounts_opened(self) -> int:
+        return self._accounts_opened
+
+    @property
+    def net(self) -> float:
+        return self._deposits - self._withdrawals
+
+    def add(self, kind: int, amount: float) -> None:
+        if kind == WITHDRAWAL:
+            self._withdrawals += amount
+            self._withdrawal_count += 1
+        else:
+            self._deposits += amount
+            self._deposit_count += kind == DEPOSIT
+            self._accounts_opened += kind == OPEN_ACCOUNT
+
+    def merge(self, other: 'RunningTotals') -> None:
+        self._deposits += other._deposits
+        self._withdrawals += other._withdrawals
+        self._deposit_count += other._deposit_count
+        self._withdrawal_count += other._withdrawal_count
+        self._accounts_opened += other._accounts_opened
+
+    def add_postings(self, deposits: float, deposit_count: int, withdrawals: float, withdrawal_count: int) -> None:
+        "adds already summed deposits and withdrawals"
+        self._deposits += deposits
+        self._deposit_count += deposit_count
+        self._withdrawals += withdrawals
+        self._withdrawal_count += withdrawal_count
+
+    def add_many(self, kinds: Sequence[int], amounts: Sequence[float]) -> None:
+        for kind, amount in zip(kinds, amounts):
+            if kind == WITHDRAWAL:
+                self._withdrawals += amount
+            else:
+                self._deposits += amount
+        self._withdrawal_count += kinds.count(WITHDRAWAL)
+        self._deposit_count += kinds.count(DEPOSIT)
+        self._accounts_opened += kinds.count(OPEN_ACCOUNT)
+
+    def __repr__(self) -> str:
+        return 'RunningTotals(deposits={}, withdrawals={}, deposit_count={}, withdrawal_count={})'.format(
+            self._deposits, self._withdrawals, self._deposit_count, self._withdrawal_count)
+
+
+class BalanceSnapshot:
+    "every account's balance right after the journal record before position"
+    def __init__(self, position: int, timestamp: float, balances: array) -> None:
+        self._position = position
+        self._timestamp = timestamp
+        self._balances = balances
+
+    @property
+    def position(self) -> int:
+        return self._position
+
+    @property
+    def timestamp(self) -> float:
+        return self._timestamp
+
+    @property
+    def balances(self) -> array:
+        return self._balances
+
+
+# Batch item outcomes
+APPLIED, UNKNOWN_ACCOUNT, INVALID_OPERATION, INSUFFICIENT_FUNDS, INSUFFICIENT_CASH = range(5)
+
+
+class BatchResult:
+    def __init__(self, status: bytearray, balances: array, applied: bool, totals: RunningTotals) -> None:
+        self._status = status
+        self._balances = balances
+        self._applied = applied
+        self._totals = totals
+
+    @property
+    def status(self) -> bytearray:
+        "one outcome code per item, APPLIED for the ones that went through"
+        return self._status
+
+    @property
+    def balances(self) -> array:
+        """balance of each item's account right after the item, as if the batch were applied;
+        a rejected item leaves its account's balance as it was, and 0.0 for an unknown account"""
+        return self._balances
+
+    @property
+    def applied(self) -> bool:
+        "False when an all-or-nothing batch was rejected as a whole"
+        return self._applied
+
+    @property
+    def totals(self) -> RunningTotals:
+        "deposits and withdrawals that were applied"
+        return self._totals
+
+    @property
+    def cash_delta(self) -> float:
+        "cash taken in by deposits less cash paid out by withdrawals"
+        return self._totals.net
+
+    def rejected(self) -> List[int]:
+        return [i for i, status in enumerate(self._status) if status != APPLIED]
+
+
 class BankSystem:
-    def __init__(self, accounts: List[BankAccount], transactions: List[Transaction]):
+    def __init__(self, accounts: List[BankAccount], transactions: List[Transaction],
+                 journal: Optional[TransactionJournal] = None, snapshot_every: Optional[int] = None):
        self._accounts = accounts
+       self._balances = array('d')  # row customer_id holds that account's balance
+       for account in accounts:
+           account.attach(self._balances)
        self._transactions = transactions   
+       self._journal = journal  # when set, transactions are written here instead of the list
+       self._totals = RunningTotals()
+       self._teller_totals = {}
+       self._snapshot_every = snapshot_every  # journal records between automatic balance snapshots
+       self._snapshots = []
+       self._snapshot_times = []
 
     def open_account(self, customer_name: str, teller_id: int, init_deposit: float = 0):
-        customer_id = len(self._accounts)
-        account = BankAccount(customer_id, init_deposit)
-        transaction = OpenAccount(customer_id, teller_id, init_deposit)
-        self._transactions.append(transaction)
-        self._accounts.append(account)
+        customer_id = self._open_account(customer_name, teller_id, init_deposit)
+        self._maybe_snapshot()
         return customer_id
 
     def deposit(self, customer_id: int, teller_id: int, amount: float):
+        self._deposit(customer_id, teller_id, amount)
+        self._maybe_snapshot()
+
+    def withdraw(self, customer_id: int, teller_id: int, amount: float):
+        self._withdraw(customer_id, teller_id, amount)
+        self._maybe_snapshot()
+
+    def post_batch(self, kinds: Sequence[int], customer_ids: Sequence[int], amounts: Sequence[float],
+                   teller_ids: Union[int, Sequence[int]], all_or_nothing: bool = True,
+                   cash_available: Optional[float] = None) -> BatchResult:
+        """validates and applies a whole batch of DEPOSIT and WITHDRAWAL items in one pass.
+
+        Items are checked in order against the balances left by the ones before
+        them, and withdrawals also against cash_available when given. With
+        all_or_nothing a single rejection leaves everything untouched; otherwise
+        rejected items are skipped and reported. Items go straight into the
+        balance column; the first balance of every account touched is kept, and
+        written back if the batch is rejected or fails part way, logging
+        included. Applied items are logged in bulk.
+        """
+        result = self._post_batch(kinds, customer_ids, amounts, teller_ids, all_or_nothing, cash_available)
+        self._maybe_snapshot()
+        return result
+
+    # The methods below apply a posting without taking a snapshot, so that
+    # subclasses can wrap them in their locks and snapshot once those are released.
+
+    def _open_account(self, customer_name: str, teller_id: int, init_deposit: float) -> int:
+        customer_id = len(self._accounts)
+        self._record(OPEN_ACCOUNT, customer_id, teller_id, init_deposit)
+        self._accounts.append(BankAccount(customer_id, init_deposit, self._balances))
+        return customer_id
+
+    def _deposit(self, customer_id: int, teller_id: int, amount: float) -> None:
         account = self.get_account(customer_id)
         account.deposit(amount)
-        transaction = Deposit(customer_id, teller_id, amount)
-        self._transactions.append(transaction)
+        self._record(DEPOSIT, customer_id, teller_id, amount)
 
-    def withdraw(self, customer_id: int, teller_id: int, amount: float):
+    def _withdraw(self, customer_id: int, teller_id: int, amount: float) -> None:
         account = self.get_account(customer_id)
         if account.balance >= amount:
             account.withdraw(amount)
         else:
             raise Exception("Insufficient Fund!")
-        transaction = Withdrawal(customer_id, teller_id, amount)
-        self._transactions.append(transaction)    
+        self._record(WITHDRAWAL, customer_id, teller_id, amount)
+
+    def _post_batch(self, kinds: Sequence[int], customer_ids: Sequence[int], amounts: Sequence[float],
+                    teller_ids: Union[int, Sequence[int]], all_or_nothing: bool,
+                    cash_available: Optional[float]) -> BatchResult:
+        n = len(kinds)
+        if len(customer_ids) != n or len(amounts) != n:
+            raise ValueError('Batch columns should have the same length')
+        if isinstance(teller_ids, int):
+            teller_ids = array('q', [teller_ids]) * n
+        elif len(teller_ids) != n:
+            raise ValueError('Batch columns should have the same length')
+        column = self._balances
+        n_accounts = len(column)
+        touched = {}  # customer_id -> balance before the batch, for each account it wrote
+        status = bytearray(n)
+        balances = array('d', bytes(8 * n))
+        cash = math.inf if cash_available is None else cash_available
+        deposited = withdrawn = 0.0
+        deposit_count = withdrawal_count = 0
+        try:
+            for i, kind, customer_id, amount in zip(range(n), kinds, customer_ids, amounts):
+                if not 0 <= customer_id < n_accounts:
+                    status[i] = UNKNOWN_ACCOUNT
+                    continue
+                balance = balances[i] = column[customer_id]
+                if kind != DEPOSIT and kind != WITHDRAWAL or not 0 < amount < math.inf:
+                    status[i] = INVALID_OPERATION
+                    continue
+                if kind == DEPOSIT:
+                    balance += amount
+                    cash += amount
+                    deposited += amount
+                    deposit_count += 1
+                elif amount > balance:
+                    status[i] = INSUFFICIENT_FUNDS
+                    continue
+                elif amount > cash:
+                    status[i] = INSUFFICIENT_CASH
+                    continue
+                else:
+                    balance -= amount
+                    cash -= amount
+                    withdrawn += amount
+                    withdrawal_count += 1
+                if customer_id not in touched:
+                    touched[customer_id] = column[customer_id]
+                column[customer_id] = balances[i] = balance
+            rejected = all_or_nothing and any(status)
+            if not rejected:
+                totals = RunningTotals()
+                totals.add_postings(deposited, deposit_count, withdrawn, withdrawal_count)
+                if any(status):
+                    keep = [i for i in range(n) if status[i] == APPLIED]
+                    kinds, customer_ids = [kinds[i] for i in keep], [customer_ids[i] for i in keep]
+                    teller_ids, amounts = [teller_ids[i] for i in keep], [amounts[i] for i in keep]
+                self._record_many(kinds, customer_ids, teller_ids, amounts, totals)
+        except BaseException:
+            for customer_id, balance in touched.items():
+                column[customer_id] = balance
+            raise
+        if rejected:
+            for customer_id, balance in touched.items():
+                column[customer_id] = balance
+            return BatchResult(status, balances, False, RunningTotals())
+        return BatchResult(status, balances, True, totals)
+
+    def _record_many(self, kinds: Sequence[int], customer_ids: Sequence[int], teller_ids: Sequence[int],
+                     amounts: Sequence[float], totals: Optional[RunningTotals] = None) -> None:
+        "totals, when given, already sums the items; they are only counted once the items are logged"
+        if self._journal is not None:
+            self._journal.append_many(kinds, customer_ids, teller_ids, amounts)
+        else:
+            self._transactions.extend(TRANSACTION_TYPES[kind](customer_id, teller_id, amount) for
+                                      kind, customer_id, teller_id, amount in
+                                      zip(kinds, customer_ids, teller_ids, amounts))
+        if totals is None:
+            totals = RunningTotals()
+            totals.add_many(kinds, amounts)
+        self._totals.merge(totals)
+        if len(teller_ids) and teller_ids.count(teller_ids[0]) == len(teller_ids):
+            self._totals_for_teller(teller_ids[0]).merge(totals)
+        else:
+            for kind, teller_id, amount in zip(kinds, teller_ids, amounts):
+                self._totals_for_teller(teller_id).add(kind, amount)
+
+    def _record(self, kind: int, customer_id: int, teller_id: int, amount: float) -> None:
+        self._totals.add(kind, amount)
+        self._totals_for_teller(teller_id).add(kind, amount)
+        if self._journal is not None:
+            self._journal.append(kind, customer_id, teller_id, amount)
+        else:
+            self._transactions.append(TRANSACTION_TYPES[kind](customer_id, teller_id, amount))
+
+    def _totals_for_teller(self, teller_id: int) -> RunningTotals:
+        totals = self._teller_totals.get(teller_id)
+        if totals is None:
+            totals = self._teller_totals[teller_id] = RunningTotals()
+        return totals
+
+    @property
+    def totals(self) -> RunningTotals:
+        "bank-wide; totals.net is the sum of all account balances"
+        return self._totals
+
+    def teller_totals(self, teller_id: int) -> RunningTotals:
+        return self._teller_totals.get(teller_id, RunningTotals())
+
+    def _maybe_snapshot(self) -> None:
+        "takes a balance snapshot once snapshot_every records have been journaled since the last one"
+        if (self._snapshot_every is not None and self._journal is not None and
+                self._journal.end_position - self._last_snapshot_position() >= self._snapshot_every):
+            self.take_balance_snapshot()
+
+    def _last_snapshot_position(self) -> int:
+        return self._snapshots[-1].position if self._snapshots else self._journal.first_position
+
+    @property
+    def snapshots(self) -> List[BalanceSnapshot]:
+        return self._snapshots
+
+    def take_balance_snapshot(self) -> BalanceSnapshot:
+        if self._journal is None:
+            raise ValueError('Balance snapshots need a transaction journal')
+        snapshot = BalanceSnapshot(self._journal.end_position, time.time(), array('d', self._balances))
+        self._snapshots.append(snapshot)
+        self._snapshot_times.append(snapshot.timestamp)
+        return snapshot
+
+    def balance_at(self, customer_id: int, timestamp: float) -> float:
+        "balance of an account at a point in time: the latest snapshot before it plus that account's later records"
+        if self._journal is None:
+            raise ValueError('Balance history needs a transaction journal')
+        i = bisect_right(self._snapshot_times, timestamp) - 1
+        if i >= 0:
+            snapshot = self._snapshots[i]
+            if snapshot.position < self._journal.first_position:
+                raise ValueError('Journal records since the balance snapshot for that time are archived')
+            balances = snapshot.balances
+            balance = balances[customer_id] if customer_id < len(balances) else 0.0
+            start = snapshot.position
+        elif self._journal.first_position == 0:
+            balance, start = 0.0, 0
+        else:
+            raise ValueError('No balance snapshot that early and older journal segments are archived')
+        positions = self._journal.account_positions(customer_id)
+        for position in positions[bisect_left(positions, start):]:
+            kind, _, _, amount, recorded_at = self._journal.record(position)
+            if recorded_at > timestamp:
+                break
+            balance += -amount if kind == WITHDRAWAL else amount
+        return balance
 
     @property
     def transactions(self) -> List[Transaction]:
+        if self._journal is not None:
+            return self._journal.transactions()
         return self._transactions
+
+    @property
+    def journal(self) -> Optional[TransactionJournal]:
+        return self._journal
+
+    def account_history(self, customer_id: int) -> List[Transaction]:
+        if self._journal is not None:
+            return self._journal.account_history(customer_id)
+        return [transaction for transaction in self._transactions if transaction.customer_id == customer_id]
     
     @property
     def accounts(self) -> List[BankAccount]:
         return self._accounts
+
+    @property
+    def balances(self) -> array:
+        "every account's balance, by customer id"
+        return self._balances
     
     def get_account(self, customer_id: int) -> BankAccount:
         return self._accounts[customer_id]
@@ -121,6 +739,20 @@ class BankBranch:
         self._tellers = tellers
         self._bank_system = bank_system
         self._address = address
+        self._totals = RunningTotals()
+
+    @property
+    def address(self) -> str:
+        return self._address
+
+    @property
+    def total_cash(self) -> float:
+        return self._total_cash
+
+    @property
+    def totals(self) -> RunningTotals:
+        "cash deposits and withdrawals handled by this branch"
+        return self._totals
         
     def add_teller(self, teller: Teller) -> None:
         self._tellers.append(teller)
@@ -147,7 +779,12 @@ class BankBranch:
         teller = self.assign_teller()
         if amount <= self._total_cash:
             self._total_cash -= amount
-            return self._bank_system.withdraw(customer_id, teller.teller_id, amount)
+            try:
+                self._bank_system.withdraw(customer_id, teller.teller_id, amount)
+            except Exception:
+                self._total_cash += amount
+                raise
+            self._totals.add(WITHDRAWAL, amount)
         else:
             raise ValueError("Branch does not have enough cash")
 
@@ -156,10 +793,24 @@ class BankBranch:
             raise ValueError('Branch does not have any tellers')
         teller = self.assign_teller()
         self._total_cash += amount
-        return self._bank_system.deposit(customer_id, teller.teller_id, amount)
+        self._bank_system.deposit(customer_id, teller.teller_id, amount)
+        self._totals.add(DEPOSIT, amount)
+
+    def post_batch(self, kinds: Sequence[int], customer_ids: Sequence[int], amounts: Sequence[float],
+                   all_or_nothing: bool = True) -> BatchResult:
+        "settles a batch through one teller, paying withdrawals out of the branch's cash"
+        if len(self._tellers) == 0:
+            raise ValueError('Branch does not have any tellers')
+        teller = self.assign_teller()
+        result = self._bank_system.post_batch(kinds, customer_ids, amounts, teller.teller_id, all_or_nothing,
+                                              self._total_cash)
+        self._total_cash += result.cash_delta
+        self._totals.merge(result.totals)
+        return result
+
     def give_cash_to_hq(self, ratio):
-        cash_to_collect = round(self._cash_on_hand * ratio)
-        self._cash_on_hand -= cash_to_collect
+        cash_to_collect = round(self._total_cash * ratio)
+        self._total_cash -= cash_to_collect
         return cash_to_collect
 
 class BankHQ:
@@ -169,10 +820,24 @@ class BankHQ:
         self._total_cash = total_cash
 
     def add_branch(self, address: str, initial_fund: int) -> None:
-        branch = BankBranch(address, initial_fund, bank_system)
+        branch = BankBranch(address, initial_fund, self._bank_system)
         self._branches.append(branch)
         return branch
 
+    @property
+    def total_cash(self) -> float:
+        return self._total_cash
+
+    @property
+    def totals(self) -> RunningTotals:
+        return self._bank_system.totals
+
+    def branch_totals(self) -> Dict[str, RunningTotals]:
+        return {branch.address: branch.totals for branch in self._branches}
+
+    def teller_totals(self, teller_id: int) -> RunningTotals:
+        return self._bank_system.teller_totals(teller_id)
+
     def collect_cash(self, ratio: float):
         for branch in self._branches:
             cash_collected = branch.give_cash_to_hq(ratio)
@@ -182,6 +847,220 @@ class BankHQ:
         for transaction in self._bank_system.transactions:
             print(transaction.get_transaction_description())
 
+class ConcurrentBankSystem(BankSystem):
+    """BankSystem that branches can call from many threads.
+
+    Accounts map onto a fixed set of lock stripes by customer id. A transfer
+    takes both stripes in stripe order, so two opposite transfers cannot
+    deadlock. Appends to the transaction log have their own lock and happen
+    while the account lock is still held, so each account's log entries are
+    in the order they were applied.
+    """
+    def __init__(self, accounts: List[BankAccount], transactions: List[Transaction],
+                 journal: Optional[TransactionJournal] = None, snapshot_every: Optional[int] = None,
+                 n_stripes: int = 64):
+        super().__init__(accounts, transactions, journal, snapshot_every)
+        self._stripes = [threading.Lock() for _ in range(n_stripes)]
+        self._accounts_lock = threading.Lock()
+        self._log_lock = threading.Lock()
+
+    def _stripe(self, customer_id: int) -> int:
+        return customer_id % len(self._stripes)
+
+    def _open_account(self, customer_name: str, teller_id: int, init_deposit: float) -> int:
+        with self._accounts_lock:
+            return super()._open_account(customer_name, teller_id, init_deposit)
+
+    def _deposit(self, customer_id: int, teller_id: int, amount: float) -> None:
+        with self._stripes[self._stripe(customer_id)]:
+            super()._deposit(customer_id, teller_id, amount)
+
+    def _withdraw(self, customer_id: int, teller_id: int, amount: float) -> None:
+        with self._stripes[self._stripe(customer_id)]:
+            super()._withdraw(customer_id, teller_id, amount)
+
+    def take_balance_snapshot(self) -> BalanceSnapshot:
+        with ExitStack() as stack:
+            for stripe in self._stripes:
+                stack.enter_context(stripe)
+            with self._accounts_lock, self._log_lock:
+                return super().take_balance_snapshot()
+
+    def transfer(self, src_customer_id: int, dst_customer_id: int, teller_id: int, amount: float) -> None:
+        "moves money between accounts atomically; logged as a withdrawal followed by a deposit"
+        if amount <= 0:
+            raise ValueError('Transfer amount should be positive')
+        first, second = sorted((self._stripe(src_customer_id), self._stripe(dst_customer_id)))
+        with self._stripes[first]:
+            with self._stripes[second] if second != first else nullcontext():
+                src, dst = self.get_account(src_customer_id), self.get_account(dst_customer_id)
+                if not src.withdraw(amount):
+                    raise Exception("Insufficient Fund!")
+                dst.deposit(amount)
+                with self._log_lock:
+                    super()._record(WITHDRAWAL, src_customer_id, teller_id, amount)
+                    super()._record(DEPOSIT, dst_customer_id, teller_id, amount)
+        self._maybe_snapshot()
+
+    def _post_batch(self, kinds: Sequence[int], customer_ids: Sequence[int], amounts: Sequence[float],
+                    teller_ids: Union[int, Sequence[int]], all_or_nothing: bool,
+                    cash_available: Optional[float]) -> BatchResult:
+        "holds every stripe, in order, for the duration of the batch"
+        with ExitStack() as stack:
+            for stripe in self._stripes:
+                stack.enter_context(stripe)
+            return super()._post_batch(kinds, customer_ids, amounts, teller_ids, all_or_nothing, cash_available)
+
+    def _record(self, kind: int, customer_id: int, teller_id: int, amount: float) -> None:
+        with self._log_lock:
+            super()._record(kind, customer_id, teller_id, amount)
+
+    def _record_many(self, kinds: Sequence[int], customer_ids: Sequence[int], teller_ids: Sequence[int],
+                     amounts: Sequence[float], totals: Optional[RunningTotals] = None) -> None:
+        with self._log_lock:
+            super()._record_many(kinds, customer_ids, teller_ids, amounts, totals)
+
+
+class ConcurrentBankBranch(BankBranch):
+    "BankBranch whose cash drawer is guarded, for use with ConcurrentBankSystem"
+    def __init__(self, address: str, total_cash: float, bank_system: ConcurrentBankSystem,
+                 tellers: Optional[List[Teller]] = None) -> None:
+        super().__init__(address, total_cash, bank_system, [] if tellers is None else tellers)
+        self._cash_lock = threading.Lock()
+
+    def withdraw(self, customer_id, amount):
+        if len(self._tellers) == 0:
+            raise ValueError('Branch does not have any tellers')
+        teller = self.assign_teller()
+        with self._cash_lock:
+            if amount > self._total_cash:
+                raise ValueError("Branch does not have enough cash")
+            self._total_cash -= amount
+        try:
+            self._bank_system.withdraw(customer_id, teller.teller_id, amount)
+        except Exception:
+            with self._cash_lock:
+                self._total_cash += amount
+            raise
+        with self._cash_lock:
+            self._totals.add(WITHDRAWAL, amount)
+
+    def deposit(self, customer_id, amount):
+        if len(self._tellers) == 0:
+            raise ValueError('Branch does not have any tellers')
+        teller = self.assign_teller()
+        with self._cash_lock:
+            self._total_cash += amount
+        self._bank_system.deposit(customer_id, teller.teller_id, amount)
+        with self._cash_lock:
+            self._totals.add(DEPOSIT, amount)
+
+    def transfer(self, src_customer_id: int, dst_customer_id: int, amount: float) -> None:
+        if len(self._tellers) == 0:
+            raise ValueError('Branch does not have any tellers')
+        self._bank_system.transfer(src_customer_id, dst_customer_id, self.assign_teller().teller_id, amount)
+
+    def post_batch(self, kinds: Sequence[int], customer_ids: Sequence[int], amounts: Sequence[float],
+                   all_or_nothing: bool = True) -> BatchResult:
+        with self._cash_lock:
+            return super().post_batch(kinds, customer_ids, amounts, all_or_nothing)
+
+    def give_cash_to_hq(self, ratio):
+        with self._cash_lock:
+            return super().give_cash_to_hq(ratio)
+
+
+def check_conservation(bank_system: BankSystem, branches: List[BankBranch], expected_net: float,
+                       tolerance: float = 1e-6) -> None:
+    """raises ValueError unless money is conserved: account balances less branch cash
+    stay at expected_net (deposits and withdrawals move both by the same amount,
+    transfers neither), no balance is negative and each balance matches its log"""
+    balances = [account.balance for account in bank_system.accounts]
+    if any(balance < -tolerance for balance in balances):
+        raise ValueError('Negative balance found')
+    net = sum(balances) - sum(branch.total_cash for branch in branches)
+    if abs(net - expected_net) > tolerance * max(1.0, abs(expected_net)):
+        raise ValueError('Money not conserved: expected {}, found {}'.format(expected_net, net))
+    replayed = [0.0] * len(balances)
+    for transaction in bank_system.transactions:
+        sign = -1 if isinstance(transaction, Withdrawal) else 1
+        replayed[transaction.customer_id] += sign * transaction.amount
+    for customer_id, (balance, logged) in enumerate(zip(balances, replayed)):
+        if abs(balance - logged) > tolerance * max(1.0, abs(balance)):
+            raise ValueError('Account {} balance {} does not match its log {}'.format(customer_id, balance, logged))
+
+
+def benchmark_concurrent_bank(n_threads: int = 8, n_accounts: int = 100, operations_per_thread: int = 20000,
+                              n_branches: int = 4, seed: int = 0) -> float:
+    "hammers a few hot accounts from many threads, checks conservation and returns operations/sec"
+    bank_system = ConcurrentBankSystem([], [])
+    branches = []
+    for branch_idx in range(n_branches):
+        branch = ConcurrentBankBranch('branch {}'.format(branch_idx), 1e6, bank_system)
+        branch.add_teller(Teller(branch_idx))
+        branches.append(branch)
+    for customer_id in range(n_accounts):
+        bank_system.open_account('customer {}'.format(customer_id), 0, 100)
+    expected_net = sum(account.balance for account in bank_system.accounts) - n_branches * 1e6
+
+    def worker(thread_idx: int) -> None:
+        rng = random.Random('{}:{}'.format(seed, thread_idx))
+        branch = branches[thread_idx % n_branches]
+        for _ in range(operations_per_thread):
+            operation = rng.random()
+            customer_id = rng.randrange(n_accounts)
+            amount = rng.randint(1, 50)
+            try:
+                if operation < 0.5:
+                    branch.transfer(customer_id, rng.randrange(n_accounts), amount)
+                elif operation < 0.75:
+                    branch.deposit(customer_id, amount)
+                else:
+                    branch.withdraw(customer_id, amount)
+            except Exception as e:
+                if str(e) != 'Insufficient Fund!':
+                    raise
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        for future in [executor.submit(worker, thread_idx) for thread_idx in range(n_threads)]:
+            future.result()
+    elapsed = time.perf_counter() - start
+    check_conservation(bank_system, branches, expected_net)
+    return n_threads * operations_per_thread / elapsed
+
+
+def benchmark_batch_posting(n_items: int = 200000, n_accounts: int = 10000, journal_dir: Optional[str] = None,
+                            seed: int = 0) -> Dict[str, float]:
+    "operations/sec of BankBranch.deposit/withdraw one call at a time against one post_batch call"
+    rng = random.Random(seed)
+    kinds = array('B', (DEPOSIT if rng.random() < 0.6 else WITHDRAWAL for _ in range(n_items)))
+    customer_ids = array('q', (rng.randrange(n_accounts) for _ in range(n_items)))
+    amounts = array('d', (rng.randint(1, 500) for _ in range(n_items)))
+    rates = {}
+    for mode in ('per_call', 'batch'):
+        journal = None
+        if journal_dir is not None:
+            journal = TransactionJournal(os.path.join(journal_dir, mode))
+        bank_system = BankSystem([], [], journal)
+        branch = BankBranch('benchmark', 1e12, bank_system, [Teller(0), Teller(1)])
+        for _ in range(n_accounts):
+            bank_system.open_account('customer', 0, 1000)
+        start = time.perf_counter()
+        if mode == 'batch':
+            branch.post_batch(kinds, customer_ids, amounts, all_or_nothing=False)
+        else:
+            for kind, customer_id, amount in zip(kinds, customer_ids, amounts):
+                if kind == DEPOSIT:
+                    branch.deposit(customer_id, amount)
+                elif bank_system.get_account(customer_id).balance >= amount:
+                    branch.withdraw(customer_id, amount)
+        rates[mode] = n_items / (time.perf_counter() - start)
+        if journal is not None:
+            journal.close()
+    return rates
+
+
 if __name__ == '__main__':
     bank_system = BankSystem([], [])
     bank = BankHQ([], bank_system, 10000)
@@ -1,5 +1,14 @@
-from typing import List, Dict, Optional
+from typing import Callable, Collection, Hashable, Iterable, List, Dict, Iterator, Optional, Sequence, Tuple, Union
+from array import array
+from bisect import bisect_left
+from heapq import heappop, heappush, nsmallest
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from enum import Enum
+from multiprocessing import shared_memory
+import random
+import sys
+import time
+import tracemalloc
 
 
 class MovieRating(Enum):
@@ -39,12 +48,129 @@ class Movie:
         return self._movie_id
 
 
+class MovieRanking:
+    """movies ordered by average rating, best first with ties going to the earliest movie, kept current as ratings change;
+    movies with fewer than min_count ratings are left out, and prior_weight > 0 shrinks each average towards prior_mean;
+    entries sit in a binary heap that tracks each movie's position, so a re-rating is a sift rather than a list shift"""
+    def __init__(self, min_count: int = 1, prior_weight: float = 0.0, prior_mean: float = 3.0) -> None:
+        if min_count < 1:
+            raise ValueError('min_count must be at least 1')
+        if prior_weight < 0:
+            raise ValueError('prior_weight must not be negative')
+        self._min_count = min_count
+        self._prior_weight = prior_weight
+        self._prior_mean = prior_mean
+        self._heap = []  # (-score, order, movie), smallest first
+        self._positions = {}  # key: movie, value: index of its entry in _heap
+
+    @property
+    def min_count(self) -> int:
+        return self._min_count
+
+    @property
+    def prior_weight(self) -> float:
+        return self._prior_weight
+
+    @property
+    def prior_mean(self) -> float:
+        return self._prior_mean
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def score(self, total: int, count: int) -> float:
+        return (total + self._prior_weight * self._prior_mean) / (count + self._prior_weight)
+
+    def update(self, movie: Hashable, order: int, total: int, count: int) -> None:
+        "re-rank movie after its rating total or count changed; order breaks ties"
+        position = self._positions.get(movie)
+        if count < self._min_count:
+            if position is not None:
+                self._remove(position)
+            return
+        entry = (-self.score(total, count), order, movie)
+        if position is None:
+            position = len(self._heap)
+            self._heap.append(entry)
+        else:
+            self._heap[position] = entry
+        self._sift(position)
+
+    def top(self, k: int) -> List[Hashable]:
+        return [movie for _, _, movie in nsmallest(k, self._heap)]
+
+    def best(self) -> Optional[Hashable]:
+        return self._heap[0][2] if self._heap else None
+
+    def best_unseen(self, seen: Collection, candidates: Optional[Collection] = None) -> Optional[Hashable]:
+        """the best ranked movie not in seen, restricted to candidates if given;
+        walks the ranking from the top, or scans candidates when there are fewer of them"""
+        if candidates is not None and len(candidates) < len(self._heap):
+            heap, positions = self._heap, self._positions
+            best_entry = min((heap[positions[movie]] for movie in candidates if movie not in seen and movie in positions),
+                             default=None)
+            return best_entry[2] if best_entry is not None else None
+        if candidates is not None and not isinstance(candidates, (set, frozenset, dict)):
+            candidates = set(candidates)
+        for _, _, movie in self._in_order():
+            if movie not in seen and (candidates is None or movie in candidates):
+                return movie
+        return None
+
+    def _in_order(self) -> Iterator[Tuple[float, int, Hashable]]:
+        "heap entries best first; keeps a frontier of reachable entries, so stopping early costs O(steps * log steps)"
+        heap = self._heap
+        frontier = [(heap[0], 0)] if heap else []
+        while frontier:
+            entry, position = heappop(frontier)
+            yield entry
+            for child in (2 * position + 1, 2 * position + 2):
+                if child < len(heap):
+                    heappush(frontier, (heap[child], child))
+
+    def _remove(self, position: int) -> None:
+        heap = self._heap
+        del self._positions[heap[position][2]]
+        last = heap.pop()
+        if position < len(heap):
+            heap[position] = last
+            self._sift(position)
+
+    def _sift(self, position: int) -> None:
+        "moves the entry at position up or down until the heap order holds, keeping _positions in step"
+        heap, positions = self._heap, self._positions
+        entry = heap[position]
+        while position > 0:
+            parent = (position - 1) >> 1
+            if heap[parent] <= entry:
+                break
+            heap[position] = heap[parent]
+            positions[heap[position][2]] = position
+            position = parent
+        n = len(heap)
+        while 2 * position + 1 < n:
+            child = 2 * position + 1
+            if child + 1 < n and heap[child + 1] < heap[child]:
+                child += 1
+            if entry <= heap[child]:
+                break
+            heap[position] = heap[child]
+            positions[heap[position][2]] = position
+            position = child
+        heap[position] = entry
+        positions[entry[2]] = position
+
+
 class RatingsData:
-    def __init__(self) -> None:
+    def __init__(self, min_count: int = 1, prior_weight: float = 0.0, prior_mean: float = 3.0) -> None:
         self._user_movies = {}  # key: user_id, value: Set[Movie]
         self._movie_ratings = {}  # Map<movie_id, Map<User_id, rating>>
         self._movies = []
         self._users = []
+        self._user_index = {}  # key: user_id, value: position in _users
+        self._movie_index = {}  # key: movie_id, value: position in _movies
+        self._rating_totals = {}  # key: movie_id, value: sum of its ratings
+        self._ranking = MovieRanking(min_count, prior_weight, prior_mean)
 
     @property
     def user_movies(self):
@@ -62,30 +188,413 @@ class RatingsData:
     def movies(self) -> List[Movie]:
         return self._movies
 
+    @property
+    def ranking(self) -> MovieRanking:
+        "movie ids by average rating"
+        return self._ranking
+
+    def user(self, user_id: int) -> User:
+        return self._users[self._user_index[user_id]]
+
+    def user_position(self, user_id: int) -> int:
+        return self._user_index[user_id]
+
+    def movie(self, movie_id: int) -> Movie:
+        return self._movies[self._movie_index[movie_id]]
+
     def add_rating(self, user: User, movie: Movie, rating: MovieRating) -> None:
         if user.user_id not in self._user_movies:
             self._user_movies[user.user_id] = set()
+            self._user_index[user.user_id] = len(self._users)
             self._users.append(user)
         self._user_movies[user.user_id].add(movie.movie_id)
         if movie.movie_id not in self._movie_ratings:
             self._movie_ratings[movie.movie_id] = {}
+            self._movie_index[movie.movie_id] = len(self._movies)
             self._movies.append(movie)
-        self._movie_ratings[movie.movie_id][user.user_id] = rating
+            self._rating_totals[movie.movie_id] = 0
+        raters = self._movie_ratings[movie.movie_id]
+        previous = raters.get(user.user_id)
+        raters[user.user_id] = rating
+        total = self._rating_totals[movie.movie_id] + rating.value - (previous.value if previous is not None else 0)
+        self._rating_totals[movie.movie_id] = total
+        self._ranking.update(movie.movie_id, self._movie_index[movie.movie_id], total, len(raters))
 
     def get_average_rating(self, movie_id: int) -> float:
         if movie_id not in self._movie_ratings:
             return MovieRating.NOT_SEEN.value
-        average_rating = 0
-        for rating in self._movie_ratings[movie_id].values():
-            average_rating += rating.value
-        average_rating /= len(self._movie_ratings[movie_id].values())
-        return average_rating
+        return self._rating_totals[movie_id] / len(self._movie_ratings[movie_id])
+
+
+def _transpose(indptr: array, indices: array, values: array, n_columns: int) -> Tuple[array, array, array]:
+    "the same sparse matrix in the other orientation, with each column's rows in ascending order"
+    counts = [0] * (n_columns + 1)
+    for column in indices:
+        counts[column + 1] += 1
+    for column in range(n_columns):
+        counts[column + 1] += counts[column]
+    next_slot = counts[:-1]
+    transposed_indices = array('i', [0]) * len(indices)
+    transposed_values = array('B', bytes(len(values)))
+    for row in range(len(indptr) - 1):
+        for k in range(indptr[row], indptr[row + 1]):
+            column = indices[k]
+            slot = next_slot[column]
+            transposed_indices[slot] = row
+            transposed_values[slot] = values[k]
+            next_slot[column] = slot + 1
+    return array('q', counts), transposed_indices, transposed_values
+
+
+class CompactRatingsStore:
+    """ratings under dense user/movie indices, in paired CSR (user-major) and CSC (movie-major) uint8 arrays;
+    add_rating goes to a small append buffer that is merged at merge_threshold entries or on the next read"""
+    def __init__(self, merge_threshold: int = 1 << 16, min_count: int = 1, prior_weight: float = 0.0, prior_mean: float = 3.0) -> None:
+        if merge_threshold < 1:
+            raise ValueError('merge_threshold must be positive')
+        self._merge_threshold = merge_threshold
+        self._user_index = {}  # key: user_id, value: dense user index
+        self._movie_index = {}  # key: movie_id, value: dense movie index
+        self._user_ids = array('q')
+        self._movie_ids = array('q')
+        self._movie_names = []
+        # row u: movies and ratings in [user_indptr[u], user_indptr[u + 1]), ascending by movie index
+        self._user_indptr = array('q', [0])
+        self._user_movies = array('i')
+        self._user_ratings = array('B')
+        # column m: users and ratings in [movie_indptr[m], movie_indptr[m + 1]), ascending by user index
+        self._movie_indptr = array('q', [0])
+        self._movie_users = array('i')
+        self._movie_ratings = array('B')
+        self._pending = {}  # key: (user index, movie index), value: rating
+        self._rating_totals = array('q')
+        self._rating_counts = array('q')
+        self._ranking = MovieRanking(min_count, prior_weight, prior_mean)
+
+    @classmethod
+    def from_ratings(cls, data: RatingsData, merge_threshold: int = 1 << 16) -> 'CompactRatingsStore':
+        "a compact copy of data, keeping its user and movie order and its ranking options"
+        ranking = data.ranking
+        store = cls(merge_threshold, ranking.min_count, ranking.prior_weight, ranking.prior_mean)
+        for user in data.users:
+            store._user_index[user.user_id] = len(store._user_ids)
+            store._user_ids.append(user.user_id)
+        for movie in data.movies:
+            store._movie_index[movie.movie_id] = len(store._movie_ids)
+            store._movie_ids.append(movie.movie_id)
+            store._movie_names.append(movie.movie_name)
+        user_index = store._user_index
+        for movie in data.movies:
+            column = sorted((user_index[user_id], rating.value) for user_id, rating in data.movie_ratings[movie.movie_id].items())
+            store._movie_users.extend(user_idx for user_idx, _ in column)
+            store._movie_ratings.extend(rating for _, rating in column)
+            store._movie_indptr.append(len(store._movie_users))
+            total = sum(rating for _, rating in column)
+            store._rating_totals.append(total)
+            store._rating_counts.append(len(column))
+            store._ranking.update(len(store._rating_counts) - 1, len(store._rating_counts) - 1, total, len(column))
+        store._user_indptr, store._user_movies, store._user_ratings = _transpose(
+            store._movie_indptr, store._movie_users, store._movie_ratings, len(store._user_ids))
+        return store
+
+    @property
+    def num_users(self) -> int:
+        return len(self._user_ids)
+
+    @property
+    def num_movies(self) -> int:
+        return len(self._movie_ids)
+
+    @property
+    def num_ratings(self) -> int:
+        self.merge()
+        return len(self._user_movies)
+
+    @property
+    def user_ids(self) -> array:
+        return self._user_ids
+
+    @property
+    def movie_ids(self) -> array:
+        return self._movie_ids
+
+    @property
+    def csr(self) -> Tuple[array, array, array]:
+        "(indptr, movie indices, ratings) by user"
+        self.merge()
+        return self._user_indptr, self._user_movies, self._user_ratings
+
+    @property
+    def csc(self) -> Tuple[array, array, array]:
+        "(indptr, user indices, ratings) by movie"
+        self.merge()
+        return self._movie_indptr, self._movie_users, self._movie_ratings
+
+    def user_index(self, user_id: int) -> Optional[int]:
+        return self._user_index.get(user_id)
+
+    def movie_index(self, movie_id: int) -> Optional[int]:
+        return self._movie_index.get(movie_id)
+
+    @property
+    def ranking(self) -> MovieRanking:
+        "movie indices by average rating"
+        return self._ranking
+
+    def movie_name(self, movie_idx: int) -> str:
+        return self._movie_names[movie_idx]
+
+    def add_rating(self, user: User, movie: Movie, rating: MovieRating) -> None:
+        user_idx = self._user_index.get(user.user_id)
+        if user_idx is None:
+            user_idx = self._user_index[user.user_id] = len(self._user_ids)
+            self._user_ids.append(user.user_id)
+        movie_idx = self._movie_index.get(movie.movie_id)
+        if movie_idx is None:
+            movie_idx = self._movie_index[movie.movie_id] = len(self._movie_ids)
+            self._movie_ids.append(movie.movie_id)
+            self._movie_names.append(movie.movie_name)
+            self._rating_totals.append(0)
+            self._rating_counts.append(0)
+        previous = self._pending.get((user_idx, movie_idx))
+        if previous is None and user_idx < len(self._user_indptr) - 1:
+            start, end = self._user_indptr[user_idx], self._user_indptr[user_idx + 1]
+            k = bisect_left(self._user_movies, movie_idx, start, end)
+            if k < end and self._user_movies[k] == movie_idx:
+                previous = self._user_ratings[k]
+        if previous is None:
+            self._rating_counts[movie_idx] += 1
+            previous = 0
+        self._rating_totals[movie_idx] += rating.value - previous
+        self._ranking.update(movie_idx, movie_idx, self._rating_totals[movie_idx], self._rating_counts[movie_idx])
+        self._pending[user_idx, movie_idx] = rating.value
+        if len(self._pending) >= self._merge_threshold:
+            self.merge()
+
+    def merge(self) -> None:
+        "fold the append buffer into the CSR arrays, a later rating replacing an earlier one, and rebuild the CSC"
+        if not self._pending:
+            return
+        pending_rows = {}
+        for (user_idx, movie_idx), rating in self._pending.items():
+            pending_rows.setdefault(user_idx, {})[movie_idx] = rating
+        self._pending = {}
+        indptr, movies, ratings = self._user_indptr, self._user_movies, self._user_ratings
+        n_rows = len(indptr) - 1
+        merged_indptr = array('q', [0])
+        merged_movies = array('i')
+        merged_ratings = array('B')
+        copied_rows = 0
+        for user_idx in sorted(pending_rows):
+            # rows untouched by the buffer are copied in one run, shifted by the entries added so far
+            run_end = min(user_idx, n_rows)
+            if copied_rows < run_end:
+                shift = len(merged_movies) - indptr[copied_rows]
+                merged_movies.extend(movies[indptr[copied_rows]:indptr[run_end]])
+                merged_ratings.extend(ratings[indptr[copied_rows]:indptr[run_end]])
+                merged_indptr.extend(indptr[row + 1] + shift for row in range(copied_rows, run_end))
+            merged_indptr.extend([len(merged_movies)] * (user_idx - max(copied_rows, run_end)))
+            row = pending_rows[user_idx]
+            if user_idx < n_rows and indptr[user_idx] < indptr[user_idx + 1]:
+                start, end = indptr[user_idx], indptr[user_idx + 1]
+                existing = dict(zip(movies[start:end], ratings[start:end]))
+                existing.update(row)
+                row = existing
+            for movie_idx in sorted(row):
+                merged_movies.append(movie_idx)
+                merged_ratings.append(row[movie_idx])
+            merged_indptr.append(len(merged_movies))
+            copied_rows = user_idx + 1
+        if copied_rows < n_rows:
+            shift = len(merged_movies) - indptr[copied_rows]
+            merged_movies.extend(movies[indptr[copied_rows]:])
+            merged_ratings.extend(ratings[indptr[copied_rows]:])
+            merged_indptr.extend(indptr[row + 1] + shift for row in range(copied_rows, n_rows))
+            copied_rows = n_rows
+        merged_indptr.extend([len(merged_movies)] * (len(self._user_ids) - max(copied_rows, n_rows)))
+        self._user_indptr, self._user_movies, self._user_ratings = merged_indptr, merged_movies, merged_ratings
+        self._movie_indptr, self._movie_users, self._movie_ratings = _transpose(
+            merged_indptr, merged_movies, merged_ratings, len(self._movie_ids))
+
+    def average_ratings(self) -> List[float]:
+        "average rating of every movie, by movie index"
+        return [total / count for total, count in zip(self._rating_totals, self._rating_counts)]
+
+    def get_average_rating(self, movie_id: int) -> float:
+        movie_idx = self._movie_index.get(movie_id)
+        if movie_idx is None:
+            return MovieRating.NOT_SEEN.value
+        return self._rating_totals[movie_idx] / self._rating_counts[movie_idx]
+
+
+def _csr_neighbors(user_idx: int, csr: Tuple[Sequence[int], Sequence[int], Sequence[int]],
+                   csc: Tuple[Sequence[int], Sequence[int], Sequence[int]]) -> List[Tuple[int, float]]:
+    "(user index, similarity score) of every other user sharing a movie with user_idx, walking the CSC columns of its movies"
+    indptr, movies, ratings = csr
+    movie_indptr, movie_users, movie_ratings = csc
+    overlaps = {}
+    differences = {}
+    for k in range(indptr[user_idx], indptr[user_idx + 1]):
+        rating = ratings[k]
+        start, end = movie_indptr[movies[k]], movie_indptr[movies[k] + 1]
+        for other_idx, other_rating in zip(movie_users[start:end], movie_ratings[start:end]):
+            overlaps[other_idx] = overlaps.get(other_idx, 0) + 1
+            differences[other_idx] = differences.get(other_idx, 0) + abs(rating - other_rating)
+    del overlaps[user_idx]
+    return [(other_idx, differences[other_idx] / overlaps[other_idx]) for other_idx in sorted(overlaps)]
+
+
+def _csr_recommendation(user_idx: int, csr: Tuple[Sequence[int], Sequence[int], Sequence[int]],
+                        csc: Tuple[Sequence[int], Sequence[int], Sequence[int]], ranking: Union[MovieRanking, '_RankedMovies']) -> Optional[int]:
+    "movie index recommended to an existing user, with ties going to the earliest user and movie"
+    indptr, movies, ratings = csr
+    seen = dict(zip(movies[indptr[user_idx]:indptr[user_idx + 1]], ratings[indptr[user_idx]:indptr[user_idx + 1]]))
+    similarity_score = float('inf')
+    best_movie = None
+    for other_idx, score in _csr_neighbors(user_idx, csr, csc):
+        if score < similarity_score:
+            similarity_score = score
+            movie_idx = ranking.best_unseen(seen, movies[indptr[other_idx]:indptr[other_idx + 1]])
+            best_movie = movie_idx if movie_idx is not None else best_movie
+    return best_movie
+
+
+class _RankedMovies:
+    "a read-only MovieRanking over movie indices, from the ranked order and each movie's position in it (-1 if unranked)"
+    def __init__(self, ranked: Sequence[int], positions: Sequence[int]) -> None:
+        self._ranked = ranked
+        self._positions = positions
+
+    def best_unseen(self, seen: Collection, candidates: Optional[Collection] = None) -> Optional[int]:
+        if candidates is not None and len(candidates) < len(self._ranked):
+            positions = self._positions
+            best_position = min((positions[movie_idx] for movie_idx in candidates
+                                 if movie_idx not in seen and positions[movie_idx] >= 0), default=None)
+            return self._ranked[best_position] if best_position is not None else None
+        if candidates is not None:
+            candidates = set(candidates)
+        for movie_idx in self._ranked:
+            if movie_idx not in seen and (candidates is None or movie_idx in candidates):
+                return movie_idx
+        return None
+
+
+class SharedRatingsArrays:
+    """a CompactRatingsStore's CSR, CSC and ranking arrays copied into one shared memory block;
+    other processes attach to it by its layout and read the arrays in place"""
+    _FIELDS = ('user_indptr', 'user_movies', 'user_ratings', 'movie_indptr', 'movie_users', 'movie_ratings',
+               'ranked', 'rank_positions')
+
+    def __init__(self, shm: shared_memory.SharedMemory, layout: Tuple[str, Tuple], owner: bool) -> None:
+        self._shm = shm
+        self._layout = layout
+        self._owner = owner
+        self._views = {}
+        for field, typecode, offset, length in layout[1]:
+            self._views[field] = shm.buf[offset:offset + length * array(typecode).itemsize].cast(typecode)
+
+    @classmethod
+    def create(cls, store: CompactRatingsStore) -> 'SharedRatingsArrays':
+        ranked = array('i', store.ranking.top(len(store.ranking)))
+        positions = array('i', [-1]) * store.num_movies
+        for position, movie_idx in enumerate(ranked):
+            positions[movie_idx] = position
+        arrays = store.csr + store.csc + (ranked, positions)
+        fields = []
+        size = 0
+        for field, values in zip(cls._FIELDS, arrays):
+            fields.append((field, values.typecode, size, len(values)))
+            size += -(-len(values) * values.itemsize // 8) * 8
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        for (_, _, offset, _), values in zip(fields, arrays):
+            nbytes = len(values) * values.itemsize
+            shm.buf[offset:offset + nbytes] = memoryview(values).cast('B')
+        return cls(shm, (shm.name, tuple(fields)), True)
+
+    @classmethod
+    def attach(cls, layout: Tuple[str, Tuple]) -> 'SharedRatingsArrays':
+        return cls(shared_memory.SharedMemory(name=layout[0]), layout, False)
+
+    @property
+    def layout(self) -> Tuple[str, Tuple]:
+        "the picklable description attach() takes"
+        return self._layout
+
+    @property
+    def csr(self) -> Tuple[memoryview, memoryview, memoryview]:
+        return self._views['user_indptr'], self._views['user_movies'], self._views['user_ratings']
+
+    @property
+    def csc(self) -> Tuple[memoryview, memoryview, memoryview]:
+        return self._views['movie_indptr'], self._views['movie_users'], self._views['movie_ratings']
+
+    @property
+    def ranking(self) -> _RankedMovies:
+        return _RankedMovies(self._views['ranked'], self._views['rank_positions'])
+
+    def close(self) -> None:
+        "detach, and free the block if this process created it"
+        for view in self._views.values():
+            view.release()
+        self._views = {}
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+    def __enter__(self) -> 'SharedRatingsArrays':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+_worker_ratings = None  # the SharedRatingsArrays a recommend_all worker process reads
+
+
+def _attach_worker_ratings(layout: Tuple[str, Tuple]) -> None:
+    global _worker_ratings
+    _worker_ratings = SharedRatingsArrays.attach(layout)
+
+
+def _recommend_user_chunk(user_indices: List[int]) -> List[Tuple[int, Optional[int]]]:
+    csr, csc, ranking = _worker_ratings.csr, _worker_ratings.csc, _worker_ratings.ranking
+    return [(user_idx, _csr_recommendation(user_idx, csr, csc, ranking)) for user_idx in user_indices]
+
+
+class BatchProgress:
+    def __init__(self, done: int, total: int, elapsed: float) -> None:
+        self._done = done
+        self._total = total
+        self._elapsed = elapsed
+
+    @property
+    def done(self) -> int:
+        return self._done
+
+    @property
+    def total(self) -> int:
+        return self._total
+
+    @property
+    def elapsed(self) -> float:
+        return self._elapsed
+
+    @property
+    def fraction(self) -> float:
+        return self._done / self._total if self._total else 1.0
+
+    @property
+    def users_per_second(self) -> float:
+        return self._done / self._elapsed if self._elapsed > 0 else 0.0
+
 
 class Recommender:
-    def __init__(self, data: RatingsData):
+    def __init__(self, data: Union[RatingsData, CompactRatingsStore]):
         self._data = data
 
     def recommend_movie(self, user: User) -> Movie:
+        if isinstance(self._data, CompactRatingsStore):
+            return self._recommend_from_arrays(user)
         if user.user_id in self._data.user_movies:
             return self._recommend_to_existing_user(user)
         else:
@@ -93,30 +602,44 @@ class Recommender:
     
     def _recommend_to_new_user(self, user: User) -> Optional[str]:
         "get the movie with the highest average rating"
-        max_rating = -1
-        recommended_movie = None
-        for movie in self._data.movies:
-            movie_rating = self._data.get_average_rating(movie.movie_id)
-            if movie_rating > max_rating:
-                max_rating = movie_rating
-                recommended_movie = movie.movie_name
-        return recommended_movie
+        movie_id = self._data.ranking.best()
+        return self._data.movie(movie_id).movie_name if movie_id is not None else None
 
 
     def _recommend_to_existing_user(self, user: User) -> Optional[str]:
         "find the user with the highest similarity, recommend their favorite movie that the user have not seen"
         similarity_score = float('inf')  # the lower, the better
         best_movie = None
-        for other_user in self._data.users:
-            if other_user == user:
-                continue
-            user_similarity_score = self._get_similarity_score(user, other_user)
+        for other_user_id, user_similarity_score in self.neighbor_candidates(user):
             if user_similarity_score < similarity_score:
                 similarity_score = user_similarity_score
-                recommended_movie = self._recommend_unwatched_movie(user, other_user).movie_name
-                best_movie = recommended_movie if recommended_movie else best_movie
+                recommended_movie = self._recommend_unwatched_movie(user, self._data.user(other_user_id))
+                best_movie = recommended_movie.movie_name if recommended_movie is not None else best_movie
         return best_movie
 
+    def neighbor_candidates(self, user: User) -> List[Tuple[int, float]]:
+        """(user_id, similarity score) of every other user who shares a movie with user, in data order;
+        found through the raters of user's movies, so users with nothing in common are never touched"""
+        if isinstance(self._data, CompactRatingsStore):
+            user_idx = self._data.user_index(user.user_id)
+            if user_idx is None:
+                return []
+            user_ids = self._data.user_ids
+            return [(user_ids[other_idx], score) for other_idx, score in _csr_neighbors(user_idx, self._data.csr, self._data.csc)]
+        if user.user_id not in self._data.user_movies:
+            return []
+        overlaps = {}  # key: user_id, value: movies shared with user
+        differences = {}  # key: user_id, value: summed absolute rating difference over those movies
+        for movie_id in self._data.user_movies[user.user_id]:
+            raters = self._data.movie_ratings[movie_id]
+            rating = raters[user.user_id].value
+            for other_user_id, other_rating in raters.items():
+                overlaps[other_user_id] = overlaps.get(other_user_id, 0) + 1
+                differences[other_user_id] = differences.get(other_user_id, 0) + abs(rating - other_rating.value)
+        del overlaps[user.user_id]
+        return [(other_user_id, differences[other_user_id] / overlaps[other_user_id])
+                for other_user_id in sorted(overlaps, key=self._data.user_position)]
+
     def _get_similarity_score(self, user1: User, user2: User) -> float:
         both_seen_movies = self._data.user_movies[user1.user_id].intersection(self._data.user_movies[user2.user_id])
         if len(both_seen_movies) == 0:
@@ -128,17 +651,134 @@ class Recommender:
         return score
 
     def _recommend_unwatched_movie(self, user: User, reviewer: User) -> Optional[Movie]:
-        best_movie = None
-        max_rating = -1
-        for movie in self._data.movies:
-            if movie.movie_id in self._data.user_movies[reviewer.user_id] and movie.movie_id not in self._data.user_movies[user.user_id]:
-                rating = self._data.get_average_rating(movie.movie_id)
-                if rating > max_rating:
-                    max_rating = rating
-                    best_movie = movie
-        return best_movie
-    
-        
+        movie_id = self._data.ranking.best_unseen(self._data.user_movies[user.user_id], self._data.user_movies[reviewer.user_id])
+        return self._data.movie(movie_id) if movie_id is not None else None
+
+    def _recommend_from_arrays(self, user: User) -> Optional[str]:
+        "the same recommendations as the dict-backed methods, with ties going to the earliest user and movie"
+        store = self._data
+        user_idx = store.user_index(user.user_id)
+        if user_idx is None:
+            movie_idx = store.ranking.best()
+            return store.movie_name(movie_idx) if movie_idx is not None else None
+        movie_idx = _csr_recommendation(user_idx, store.csr, store.csc, store.ranking)
+        return store.movie_name(movie_idx) if movie_idx is not None else None
+
+    def recommend_all(self, users: Optional[Iterable[User]] = None, workers: Optional[int] = None, chunk_size: int = 256,
+                      progress: Optional[Callable[[BatchProgress], None]] = None) -> Iterator[Tuple[int, Optional[str]]]:
+        """(user_id, recommendation) for users, or for every user, yielded as worker processes finish their chunks;
+        the workers read the ratings from shared memory, and progress is called after each chunk"""
+        if chunk_size < 1:
+            raise ValueError('chunk_size must be positive')
+        start = time.perf_counter()
+        store = self._data if isinstance(self._data, CompactRatingsStore) else CompactRatingsStore.from_ratings(self._data)
+        user_ids = store.user_ids
+        requested = list(user_ids) if users is None else [user.user_id for user in users]
+        done = 0
+        user_indices = []
+        for user_id in requested:
+            user_idx = store.user_index(user_id)
+            if user_idx is None:
+                movie_idx = store.ranking.best()
+                yield user_id, store.movie_name(movie_idx) if movie_idx is not None else None
+                done += 1
+            else:
+                user_indices.append(user_idx)
+        if done and progress is not None:
+            progress(BatchProgress(done, len(requested), time.perf_counter() - start))
+        if not user_indices:
+            return
+        with SharedRatingsArrays.create(store) as shared, \
+                ProcessPoolExecutor(max_workers=workers, initializer=_attach_worker_ratings, initargs=(shared.layout,)) as executor:
+            futures = [executor.submit(_recommend_user_chunk, user_indices[first:first + chunk_size])
+                       for first in range(0, len(user_indices), chunk_size)]
+            try:
+                for future in as_completed(futures):
+                    results = future.result()
+                    for user_idx, movie_idx in results:
+                        yield user_ids[user_idx], store.movie_name(movie_idx) if movie_idx is not None else None
+                    done += len(results)
+                    if progress is not None:
+                        progress(BatchProgress(done, len(requested), time.perf_counter() - start))
+            finally:
+                for future in futures:
+                    future.cancel()
+
+
+def check_neighbor_candidates(data: RatingsData) -> None:
+    "raises ValueError unless neighbor_candidates, on data and on its compact copy, matches a full _get_similarity_score scan"
+    recommenders = [Recommender(data), Recommender(CompactRatingsStore.from_ratings(data))]
+    for user in data.users:
+        expected = []
+        for other_user in data.users:
+            if other_user.user_id != user.user_id:
+                score = recommenders[0]._get_similarity_score(user, other_user)
+                if score != float('inf'):
+                    expected.append((other_user.user_id, score))
+        for recommender in recommenders:
+            found = recommender.neighbor_candidates(user)
+            if found != expected:
+                raise ValueError('Neighbors of user {} differ from the full scan: expected {}, found {}'.format(user.user_id, expected, found))
+
+
+def generate_ratings(n_users: int, n_movies: int, ratings_per_user: int, seed: Optional[int] = None) -> Iterator[Tuple[User, Movie, MovieRating]]:
+    "a random ratings stream, each user rating ratings_per_user distinct movies"
+    rng = random.Random(seed)
+    movies = [Movie(movie_id, 'Movie {}'.format(movie_id)) for movie_id in range(n_movies)]
+    scores = [MovieRating.ONE, MovieRating.TWO, MovieRating.THREE, MovieRating.FOUR, MovieRating.FIVE]
+    for user_id in range(n_users):
+        user = User(user_id, 'User {}'.format(user_id))
+        for movie in rng.sample(movies, min(ratings_per_user, n_movies)):
+            yield user, movie, rng.choice(scores)
+
+
+def benchmark_ratings_store(n_users: int = 20000, n_movies: int = 2000, ratings_per_user: int = 20, n_queries: int = 20) -> Dict[str, float]:
+    "bytes per rating and existing-user recommendations/sec, RatingsData against CompactRatingsStore"
+    stream = list(generate_ratings(n_users, n_movies, ratings_per_user, seed=0))
+    results = {}
+    tracemalloc.start()
+    try:
+        baseline = tracemalloc.get_traced_memory()[0]
+        data = RatingsData()
+        for user, movie, rating in stream:
+            data.add_rating(user, movie, rating)
+        results['dict_bytes_per_rating'] = (tracemalloc.get_traced_memory()[0] - baseline) / len(stream)
+        baseline = tracemalloc.get_traced_memory()[0]
+        store = CompactRatingsStore()
+        for user, movie, rating in stream:
+            store.add_rating(user, movie, rating)
+        store.merge()
+        results['compact_bytes_per_rating'] = (tracemalloc.get_traced_memory()[0] - baseline) / len(stream)
+    finally:
+        tracemalloc.stop()
+    users = data.users[:n_queries]
+    for name, ratings in (('dict', data), ('compact', store)):
+        recommender = Recommender(ratings)
+        start = time.perf_counter()
+        for user in users:
+            recommender.recommend_movie(user)
+        results['{}_queries_per_second'.format(name)] = len(users) / (time.perf_counter() - start)
+    return results
+
+
+def benchmark_recommend_all(n_users: int = 5000, n_movies: int = 2000, ratings_per_user: int = 20,
+                            workers: Optional[int] = None) -> Dict[str, float]:
+    "users/sec of recommend_movie called in a loop against recommend_all, which also checks they agree"
+    store = CompactRatingsStore()
+    for user, movie, rating in generate_ratings(n_users, n_movies, ratings_per_user, seed=0):
+        store.add_rating(user, movie, rating)
+    recommender = Recommender(store)
+    start = time.perf_counter()
+    expected = {user_id: recommender.recommend_movie(User(user_id, '')) for user_id in store.user_ids}
+    loop_elapsed = time.perf_counter() - start
+    start = time.perf_counter()
+    found = dict(recommender.recommend_all(workers=workers))
+    batch_elapsed = time.perf_counter() - start
+    if found != expected:
+        raise ValueError('recommend_all disagrees with recommend_movie')
+    return {'loop_users_per_second': n_users / loop_elapsed, 'batch_users_per_second': n_users / batch_elapsed}
+
+
 if __name__ == "__main__":
     user1 = User(1, 'User 1')
     user2 = User(2, 'User 2')
@@ -154,8 +794,20 @@ if __name__ == "__main__":
     ratings.add_rating(user2, movie2, MovieRating.TWO)
     ratings.add_rating(user2, movie3, MovieRating.FOUR)
 
-    recommender = Recommender(ratings)
+    if sys.argv[1:] == ['--check']:
+        # neighbor_candidates has to agree with the full similarity scan, re-rated movies included
+        check_neighbor_candidates(ratings)
+        generated = RatingsData()
+        stream = list(generate_ratings(200, 60, 12, seed=0))
+        for user, movie, rating in stream:
+            generated.add_rating(user, movie, rating)
+        for user, movie, _ in stream[::7]:
+            generated.add_rating(user, movie, MovieRating.ONE)
+        check_neighbor_candidates(generated)
+        print('neighbor candidates agree with the full similarity scan')
+    else:
+        recommender = Recommender(ratings)
 
-    print(recommender.recommend_movie(user1)) # The Godfather
-    print(recommender.recommend_movie(user2)) # Batman Begins
-    print(recommender.recommend_movie(user3)) # Batman Begins
+        print(recommender.recommend_movie(user1)) # The Godfather
+        print(recommender.recommend_movie(user2)) # Batman Begins
+        print(recommender.recommend_movie(user3)) # Batman Begins